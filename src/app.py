@@ -1,6 +1,8 @@
 import os
 import sys
-from models import run_cluster, run_classification
+import math
+from models import run_cluster, run_assign, run_classification
+from models.common import convert_to_parquet_async
 from logger_utils import logger, upload_log_to_s3
 from flask import Flask, render_template, request, redirect, url_for, send_file, flash, jsonify, session, Response
 from werkzeug.utils import secure_filename
@@ -42,6 +44,9 @@ s3 = boto3.client('s3', region_name=S3_REGION, config=boto3.session.Config(signa
 
 S3_BUCKET_NAME = "ml-platform-service"
 
+# Default time budget for "Find Best Model", kept below gunicorn's 300 s timeout
+CLASSIFICATION_TIME_BUDGET = 240
+
 UPLOAD_FOLDER = '/tmp'
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 
@@ -102,6 +107,9 @@ def upload_file():
         upload_user_file_to_s3(file, S3_BUCKET_NAME, file.filename)
 
         print(f"File {file.filename} uploaded to S3 bucket {S3_BUCKET_NAME}")
+
+        # Convert the upload to Parquet once in the background, every later job reads the typed columnar copy
+        convert_to_parquet_async(file.filename)
         
         # File uploaded, now decide what to do based on the selected task
         if task == 'clustering':
@@ -135,12 +143,24 @@ def process_clustering(filename):
             
             threshold = float(threshold)
 
+            # Optional Agglomerative settings for large files and for connectivity-constrained merges
+            representatives = request.form.get('representatives') or 'sample'
+            if representatives not in ('sample', 'micro'):
+                raise ValueError("representatives must be 'sample' or 'micro'.")
+            
+            connectivity_neighbors = request.form.get('connectivity_neighbors')
+            connectivity_neighbors = int(connectivity_neighbors) if connectivity_neighbors else None
+            if connectivity_neighbors is not None and connectivity_neighbors < 1:
+                raise ValueError("connectivity_neighbors must be a positive integer.")
+
             # Implement main function and generate report and result file
-            pdf_file, csv_file = run_cluster(s3_file_path, threshold, algorithm, plot)
+            pdf_file, csv_file, model_file = run_cluster(s3_file_path, threshold, algorithm, plot,
+                                                         representatives=representatives, connectivity_neighbors=connectivity_neighbors)
 
             files_to_upload = {
                 f"{filename}_report.pdf": pdf_file,
-                f"{filename}_results.csv": csv_file
+                f"{filename}_results.csv": csv_file,
+                f"{filename}_cluster_model.npz": model_file
             }
 
             # Upload the generated report and result file directly to S3
@@ -150,9 +170,10 @@ def process_clustering(filename):
             # Generate presigned URL
             pdf_url = generate_presigned_url(S3_BUCKET_NAME, f"result/{filename}_report.pdf")
             csv_url = generate_presigned_url(S3_BUCKET_NAME, f"result/{filename}_results.csv")
+            model_url = generate_presigned_url(S3_BUCKET_NAME, f"result/{filename}_cluster_model.npz")
 
 
-            return render_template('clustering_result.html', pdf_url=pdf_url, csv_url=csv_url)
+            return render_template('clustering_result.html', pdf_url=pdf_url, csv_url=csv_url, model_url=model_url)
         
     # If file extention is not suported, delet the file from S3 Bucket
     except ValueError as e:
@@ -185,6 +206,32 @@ def process_classification(filename):
         return render_template('loading.html', filename=filename, model_choice=model_choice)
     return render_template('select_model.html', filename=filename)
 
+@app.route('/assign_clusters/<filename>', methods=['POST'])
+def assign_clusters(filename):
+    data = request.json or {}
+
+    # Name of the file the cluster model was fitted on
+    model_file = data.get("model")
+
+    if not filename or not model_file:
+        return jsonify({"error": "Missing filename or model"}), 400
+    
+    try:
+        csv_file = run_assign(f"uploaded/{filename}", model_file)
+
+        result_filename = f"{filename}_assigned.csv"
+        upload_to_s3_direct(S3_BUCKET_NAME, {result_filename: csv_file})
+        csv_url = generate_presigned_url(S3_BUCKET_NAME, f"result/{result_filename}")
+
+        return jsonify({"message": "Cluster assignment completed.", "csv_url": csv_url})
+    
+    except FileNotFoundError as e:
+        return jsonify({"error": str(e)}), 404
+    
+    except Exception as e:
+        print(f"\n=== Error in assign_clusters ===\n{e}\n")
+        return jsonify({"error": "Error during cluster assignment."}), 500
+
 @app.route('/start_classification/<filename>', methods=['POST'])
 def start_classification(filename):
     global progress_status
@@ -195,13 +242,24 @@ def start_classification(filename):
     if not filename or not model_choice:
         return jsonify({"error": "Missing filename or model choice"}), 400
 
+    time_budget = data.get("time_budget")
+    if time_budget is None:
+        time_budget = CLASSIFICATION_TIME_BUDGET
+    try:
+        time_budget = float(time_budget)
+    except (TypeError, ValueError):
+        return jsonify({"error": "time_budget must be a number of seconds"}), 400
+    
+    if not math.isfinite(time_budget) or time_budget <= 0:
+        return jsonify({"error": "time_budget must be a positive number of seconds"}), 400
+
     
     s3_file_path = f"uploaded/{filename}"
     progress_status = "Training started..."
 
     try:
         try:
-            pdf_file, model_buffer = run_classification(s3_file_path, model_choice=model_choice)
+            pdf_file, model_buffer = run_classification(s3_file_path, model_choice=model_choice, time_budget=time_budget)
         except Exception as e:
             return jsonify({"error": "Error during classification processing."}), 500
 
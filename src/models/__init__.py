@@ -1,4 +1,4 @@
-from .clustering_main import run_cluster
+from .clustering_main import run_cluster, run_assign
 from .classification_main import run_classification
 
-__all__ = ["run_cluster", "run_classification"]
\ No newline at end of file
+__all__ = ["run_cluster", "run_assign", "run_classification"]
\ No newline at end of file
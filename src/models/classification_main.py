@@ -1,5 +1,5 @@
 from .common import load_file
-from .classification_models import preprocess, select_model, build_model_dict, BestModel, individual_model
+from .classification_models import preprocess, select_model, build_model_registry, BestModel, individual_model
 from model_utils import save_model_with_info
 from pathlib import Path
 from reportlab.lib import colors
@@ -7,9 +7,11 @@ from reportlab.lib.pagesizes import letter, landscape
 from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Image, HRFlowable, Table, TableStyle
 from reportlab.lib.styles import ParagraphStyle, getSampleStyleSheet
 import io
+import time
 import zipfile
 
-def run_classification(file_key, model_choice):
+def run_classification(file_key, model_choice, time_budget=None):
+    start_time = time.time()
     file_name = Path(file_key).stem
 
     model_info_buffer = io.BytesIO()
@@ -47,8 +49,15 @@ def run_classification(file_key, model_choice):
         model_scores = f"Accuracy: {model_accuracy: .4f}, Score: {model_score: .4f}"
     
     elif model_choice == 'Find Best Model':
-        models, LR_best_params, LR_tuned_scores = build_model_dict(X, y)
-        best_model_name, model_names, best_model, best_score, label_map, y_type = select_model.model_selection(models, X, y, mode=mode, k=5)
+        models = build_model_registry()
+
+        # Model selection gets whatever is left of the time budget after loading and preprocessing
+        remaining_budget = None
+        if time_budget is not None:
+            remaining_budget = max(time_budget - (time.time() - start_time), 0)
+
+        best_model_name, model_names, best_model, best_score, label_map, y_type, skipped_models = select_model.model_selection(
+            models, X, y, mode=mode, k=5, time_budget=remaining_budget)
         model_name = best_model_name
         
         model_scores = f"Score with {model_name}: {best_score: .4f}"
@@ -92,6 +101,10 @@ def run_classification(file_key, model_choice):
 
         content = [title, Spacer(1, 24), file_name_para, line, continuous_text, language_column_text, bow_list_text,
                     Spacer(1, 12), model_scores_text, used_model_names_text, Spacer(1, 12), Spacer(1, 12), info_text]
+        
+        if skipped_models:
+            skipped_info = "Time budget reached: " + ", ".join(f"{name} ({status})" for name, status in skipped_models)
+            content.insert(10, Paragraph(skipped_info, styles['Normal']))
     
     else:
         content = [title, Spacer(1, 24), file_name_para, line, continuous_text,language_column_text, bow_list_text,
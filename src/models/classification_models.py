@@ -1,6 +1,7 @@
 import pandas as pd
 import numpy as np
 import math
+import copy
 from collections import defaultdict, Counter
 import re
 from nltk.corpus import stopwords
@@ -9,13 +10,15 @@ from sklearn.model_selection import train_test_split, StratifiedKFold
 from sklearn.metrics import accuracy_score, f1_score, roc_auc_score, r2_score
 from sklearn.model_selection import RandomizedSearchCV
 from sklearn.feature_selection import SelectKBest, chi2
-from joblib import Parallel, delayed
+from joblib import Parallel, delayed, effective_n_jobs, parallel_backend
+from threadpoolctl import threadpool_limits
 import gc
 from scipy.stats import uniform
 from sklearn.pipeline import Pipeline
 from sklearn.preprocessing import StandardScaler
 import time
 from logger_utils import logger
+from score_cache import score_cache, dataset_fingerprint, cache_key
 
 
 class preprocess:
@@ -43,7 +46,7 @@ class preprocess:
         Return
         - bool: True if the column is likely a language based column, else False
         '''
-        column = column_data.fillna('').astype(str)
+        column = column_data.astype(object).fillna('').astype(str)
         avg_word_count = column.apply(lambda x: len(x.split())).mean()
 
         return avg_word_count > 2
@@ -80,18 +83,20 @@ class preprocess:
         id_columns = []
 
         for col in data.columns:
-            if data[col].dtype == 'object':
+            # Strings may be loaded as category
+            is_string = data[col].dtype == 'object' or isinstance(data[col].dtype, pd.CategoricalDtype)
+            if is_string:
                 if data[col].str.len().mean() > 100:
                     continue
 
-            # Check if the column is numeric
-            if data[col].dtype in ['int64', 'float64']:
+            # Check if the column is numeric, of any width
+            if pd.api.types.is_numeric_dtype(data[col]) and not pd.api.types.is_bool_dtype(data[col]):
                 # Check if it has many unique values (likely to be an ID column)
                 if data[col].nunique() > len(data) * 0.8:  # If unique values > 80% of the dataset length
                     id_columns.append(col)
 
             # For object type columns, we can check if they have unique values
-            elif data[col].dtype == 'object' and data[col].nunique() > len(data) * 0.8:
+            elif is_string and data[col].nunique() > len(data) * 0.8:
                 if not data[col].str.contains(r'http|www|#|@').any():
                     id_columns.append(col)
 
@@ -159,7 +164,7 @@ class preprocess:
         
         # Check for columns with imbalanced class distributions
         for col in data.columns:
-            if data[col].dtype == 'object' or data[col].nunique() < 10:
+            if data[col].dtype == 'object' or isinstance(data[col].dtype, pd.CategoricalDtype) or data[col].nunique() < 10:
                 value_counts = data[col].value_counts(normalize=True)
                 
                 if value_counts.max() > 0.5:
@@ -453,7 +458,7 @@ class numeric:
     # ------------------------------------------ Decision Tree ---------------------------------------------------
     
     class DecisionTree:
-        def __init__(self, feature=None, threshold=None, left=None, right=None, value=None, mode='classification', num_class=None):
+        def __init__(self, feature=None, threshold=None, left=None, right=None, value=None, mode='classification', num_class=None, n_jobs=-1):
             '''
             DecisionTree class for classification and regression
 
@@ -464,6 +469,7 @@ class numeric:
             - right (DecisionTree): The right subtree
             - value (float or int): Value of the prediction at a leaf node
             - mode (str): Mode of the tree, either 'classification' or 'regression' (defalut = 'classification')
+            - n_jobs (int): Number of jobs used to fit subtrees in parallel (default = -1)
             '''
             self.feature = feature
             self.threshold = threshold
@@ -473,6 +479,9 @@ class numeric:
             self.mode = mode
             self.root = None
             self.num_class = num_class
+            self.n_jobs = n_jobs
+            self.deadline = None
+            self.stopped_early = False
             
         def entropy(self, y):
             '''
@@ -525,7 +534,7 @@ class numeric:
             tree.fit(X, y, depth, min_gain, n_jobs)
             return tree
         
-        def fit(self, X, y, depth=0, min_gain=0.01, n_jobs=-1):
+        def fit(self, X, y, depth=0, min_gain=0.01, n_jobs=None):
             '''
             Build the decision tree recursively
 
@@ -534,13 +543,24 @@ class numeric:
             - y (Series): Target values
             - depth (int): Current depth of the tree (default = 0)
             - min_gain (folat): Minimum information gain required to split a node (default = 0.01)
-            - n_jobs (int): Number of jobs for parallel processing (default = -1)
+            - n_jobs (int): Number of jobs for parallel processing (default = None, use self.n_jobs)
             ''' 
+            if n_jobs is None:
+                n_jobs = self.n_jobs
+
+            self.stopped_early = False
             unique_classes = np.unique(y)
             
             if self.num_class is None:
                 self.num_class = len(unique_classes)
             
+            # Stopping condition: Deadline reached, turn this node into a leaf
+            if self.deadline is not None and time.time() > self.deadline:
+                self.value = pd.Series(y).mode()[0] if self.mode == 'classification' else np.mean(y)
+                self.stopped_early = True
+                logger.debug(f"Stopping at depth {depth} due to deadline: value={self.value}")
+                return
+
             best_feature, best_threshold, best_gain = self._find_best_split(X, y)
 
             if best_gain == -float('inf'):
@@ -579,8 +599,10 @@ class numeric:
             # Create left and right subtrees
             self.feature = best_feature
             self.threshold = best_threshold
-            self.left = numeric.DecisionTree(mode=self.mode, num_class=self.num_class)
-            self.right = numeric.DecisionTree(mode=self.mode, num_class=self.num_class)
+            self.left = numeric.DecisionTree(mode=self.mode, num_class=self.num_class, n_jobs=n_jobs)
+            self.right = numeric.DecisionTree(mode=self.mode, num_class=self.num_class, n_jobs=n_jobs)
+            self.left.deadline = self.deadline
+            self.right.deadline = self.deadline
 
             results = Parallel(n_jobs=n_jobs)(
                 delayed(self._parallel_fit_subtree)(tree, X[mask], y[mask], depth + 1, min_gain, n_jobs)
@@ -588,6 +610,7 @@ class numeric:
             )
 
             self.left, self.right = results
+            self.stopped_early = self.left.stopped_early or self.right.stopped_early
 
             logger.debug(f"Tree built at depth {depth} with feature={self.feature} and threshold={self.threshold}")
 
@@ -743,7 +766,7 @@ class numeric:
     # ------------------------------------------ Random Forest ---------------------------------------------------
     class RandomForest:
         
-        def __init__(self, n_trees=None, max_depth=25, min_samples_split=2, mode='classification', random_state=None):
+        def __init__(self, n_trees=None, max_depth=25, min_samples_split=2, mode='classification', random_state=None, n_jobs=-1):
             '''
             Initialize the RandomForest model
 
@@ -752,6 +775,7 @@ class numeric:
             - max_depth (int): Maximum depth of each tree (default = 40, will be optimized)
             - min_samples_split (int): Minimum samples required to split a node (default = 2)
             - mode (str): Either 'classification' or 'regression'
+            - n_jobs (int): Number of trees trained in parallel (default = -1 for all processors)
             '''
             self.n_trees = n_trees
             self.max_depth = max_depth
@@ -760,6 +784,9 @@ class numeric:
             self.trees = []
             self.num_class = 2
             self.random_state = random_state
+            self.n_jobs = n_jobs
+            self.deadline = None
+            self.stopped_early = False
     
         def optimize_n_trees_depth(self, X, y, n_jobs=-1, random_state=42):
             '''
@@ -785,9 +812,19 @@ class numeric:
             best_score = -float('inf')
 
             def train_and_evaluate(n_trees, max_depth):
+                # Skip the remaining combinations once the deadline is reached
+                if self.deadline is not None and time.time() > self.deadline:
+                    return None, n_trees, max_depth
+
                 try:
-                    forest = numeric.RandomForest(n_trees=n_trees, max_depth=max_depth, mode=self.mode)
+                    # The search already runs in parallel, so each candidate forest trains its trees sequentially
+                    forest = numeric.RandomForest(n_trees=n_trees, max_depth=max_depth, mode=self.mode, n_jobs=1)
+                    forest.deadline = self.deadline
                     forest.fit(X_train, y_train)
+
+                    # A forest cut short by the deadline is not comparable with the complete ones
+                    if forest.stopped_early:
+                        return None, n_trees, max_depth
                     predictions = forest.predict(X_val)
                     score = accuracy_score(y_val, predictions) if self.mode == 'classification' else r2_score(y_val, predictions)
                     return score, n_trees, max_depth
@@ -804,6 +841,10 @@ class numeric:
             )
             results = [result for result in results if result[0] is not None]
 
+            if self.deadline is not None and time.time() > self.deadline:
+                self.stopped_early = True
+                logger.info(f"Deadline reached during the search, {len(results)} combinations evaluated.")
+
             if not results:
                 logger.error("No valid results from the train and evaluate process. Setting default values.")
                 return 10, 5
@@ -817,7 +858,7 @@ class numeric:
             logger.info(f"Optimal number of trees: {best_n_trees}, Optimal max depth: {best_max_depth}, Best Accuracy: {best_score}")
             return best_n_trees, best_max_depth
         
-        def fit(self, X, y, n_jobs=-1):
+        def fit(self, X, y, n_jobs=None):
             '''
             Train the RandomForest model by fitting multiple decision trees
             If optimize_hyperparameters=True, it will automatically find the best n_trees and max_depth
@@ -825,9 +866,12 @@ class numeric:
             Parameters
             - X (numpy array or DataFrame): Input feature
             - y (Series): Target labels
-            - n_jobs (int): Number of jobs for parallel processing (default=-1 for all processors)
+            - n_jobs (int): Number of jobs for parallel processing (default = None, use self.n_jobs)
             - random_state (int): Random seed (default = 42)
             '''
+            if n_jobs is None:
+                n_jobs = self.n_jobs
+
             if isinstance(X, pd.DataFrame):
                 # If already a DataFrame, return as is
                 pass
@@ -840,6 +884,7 @@ class numeric:
             
             classes, counts = np.unique(y, return_counts=True)
             self.num_class = len(classes)
+            self.stopped_early = False
 
             np.random.seed(self.random_state)
             
@@ -849,9 +894,23 @@ class numeric:
                 self.n_trees = best_n_trees
                 self.max_depth = best_max_depth
             
-            self.trees = Parallel(n_jobs=n_jobs)(
-                delayed(self._train_tree)(X, y, i) for i in range(self.n_trees)
-            )
+            if self.deadline is None:
+                self.trees = Parallel(n_jobs=n_jobs)(
+                    delayed(self._train_tree)(X, y, i) for i in range(self.n_trees)
+                )
+            else:
+                # Train the trees in batches so the forest can stop early when the deadline is reached
+                self.trees = []
+                batch_size = effective_n_jobs(n_jobs)
+                for start in range(0, self.n_trees, batch_size):
+                    if self.trees and time.time() > self.deadline:
+                        self.stopped_early = True
+                        logger.info(f"Deadline reached, stopping the forest at {len(self.trees)} of {self.n_trees} trees.")
+                        break
+
+                    self.trees += Parallel(n_jobs=n_jobs)(
+                        delayed(self._train_tree)(X, y, i) for i in range(start, min(start + batch_size, self.n_trees))
+                    )
 
             logger.info(f"Training compled. {len(self.trees)} trees trained and {self.num_class}.")
 
@@ -871,7 +930,8 @@ class numeric:
             np.random.seed(seed)
             indices = np.random.choice(len(X), len(X), replace=True)
             X_sample, y_sample = X.iloc[indices], y.iloc[indices]
-            tree = numeric.DecisionTree(mode=self.mode, num_class=self.num_class)
+            # Trees are already trained in parallel across the forest, so each tree splits its nodes sequentially
+            tree = numeric.DecisionTree(mode=self.mode, num_class=self.num_class, n_jobs=1)
             tree.fit(X, y)
             return tree
 
@@ -947,7 +1007,8 @@ class numeric:
                 'max_depth': self.max_depth,
                 'min_samples_split': self.min_samples_split,
                 'mode': self.mode,
-                'random_state': self.random_state
+                'random_state': self.random_state,
+                'n_jobs': self.n_jobs
             }
 
             if deep:
@@ -977,13 +1038,14 @@ class numeric:
 
     # ---------------------------------------- Logistic Regression -------------------------------------------------
     class LogisticRegression:
-        def __init__(self, learning_rate=0.001, max_epochs=1000, L2=0.01, num_class=2):
+        def __init__(self, learning_rate=0.001, max_epochs=1000, L2=0.01, num_class=2, deadline=None):
             '''
             Initialize the logistic regression model with parameters
 
             Parameters:
             - learning_rate (float): Step size for gradient descent (Default is 0.01)
             - max_epochs (int): Maximum number of epochs for training (Default is 500)
+            - deadline (float): Absolute time (time.time()) at which training stops, None for no deadline (Default is None)
             '''
             self.learning_rate = learning_rate
             self.max_epochs = max_epochs
@@ -991,6 +1053,8 @@ class numeric:
             self.num_class = num_class
             self.w = None
             self.b = None
+            self.deadline = deadline
+            self.stopped_early = False
 
         @staticmethod
         def sigmoid(z):
@@ -1110,8 +1174,16 @@ class numeric:
             epochs_wout_improvement = 0                     # Counter for patience
             best_w, best_b = self.w.copy(), self.b.copy()                 # Best weights and bias to restore after early stopping
 
+            self.stopped_early = False
+
             # Training loop over epochs
             for epoch in range(self.max_epochs):
+                # Stop training if the deadline is reached
+                if self.deadline is not None and time.time() > self.deadline:
+                    self.stopped_early = True
+                    logger.info(f"Deadline reached, stopping training at epoch {epoch}")
+                    break
+
                 epoch_train_loss = 0
                 epoch_val_loss = 0
 
@@ -1233,9 +1305,11 @@ class numeric:
             '''
             Return hyperparameters of the model
             '''
+            # The deadline is kept so the copies cloned by RandomizedSearchCV stop with the original
             return {'learning_rate': self.learning_rate,
                     'max_epochs': self.max_epochs,
-                    'L2': self.L2}
+                    'L2': self.L2,
+                    'deadline': self.deadline}
         
         def set_params(self, **params):
             '''
@@ -1303,7 +1377,7 @@ class Text:
 # ============================================= Tuning ===========================================================
 class tuning:
     
-    def tune_hyperparameters(model, param_dist, X, y, n_iter=100, cv=5, random_state=42, n_jobs=-1):
+    def tune_hyperparameters(model, param_dist, X, y, n_iter=100, cv=5, random_state=42, n_jobs=-1, deadline=None):
         '''
         Optimize the hyperparameters of a given model using RandomizedSearchCV and evaluate its performance
 
@@ -1316,11 +1390,20 @@ class tuning:
         - cv: Number of cross-validation folds
         - random_state: Random seed (default is 42)
         - n_jobs: Number of jobs for parallel processing (default = -1 for all processors)
+        - deadline: Absolute time (time.time()) at which the search stops, None for no deadline (default is None)
+            Every candidate fit stops at the deadline, so the remaining iterations finish at once
 
         Returns:
-        - Best hyperparameters, model performance metrics
+        - Best hyperparameters, model performance metrics (None if the deadline has already passed)
         '''   
+        if deadline is not None and time.time() > deadline:
+            logger.info("Skipping hyperparameter tuning (time budget exhausted)")
+            return None, None, None
+
         try:
+            if hasattr(model, 'deadline'):
+                model.deadline = deadline
+
             y, label_map = preprocess.map_target(y)
             num_class = len(np.unique(y))
             if hasattr(model, 'num_class'):
@@ -1347,20 +1430,16 @@ class tuning:
 
             # Predict using the best model
             best_model = random_search.best_estimator_
-            test_predictions = best_model.predict(test_X)
 
             # Evaluate metrics
             performance_metrics = {}
-            accuracy = accuracy_score(test_y, test_predictions)
-            f1 = f1_score(test_y, test_predictions, average='weighted')
-
-
             if hasattr(best_model, 'predict_proba') and callable(getattr(best_model, 'predict_proba')):
-                test_probabilities = best_model.predict_proba(test_X)
-                if test_probabilities.ndim == 1:
-                    test_probabilities = test_probabilities.reshape(-1, 1)
-                roc_auc = roc_auc_score(test_y, test_probabilities, multi_class='ovr', average='weighted')
+                metrics = evaluation.score_model(best_model, test_X, test_y, mode='classification')
+                accuracy, f1, roc_auc = metrics['accuracy'], metrics['f1'], metrics['roc_auc']
             else:
+                test_predictions = best_model.predict(test_X)
+                accuracy = accuracy_score(test_y, test_predictions)
+                f1 = f1_score(test_y, test_predictions, average='weighted')
                 roc_auc = None       # No predict_proba available
 
             performance_metrics['Accuracy'] = accuracy
@@ -1381,11 +1460,107 @@ class tuning:
             return None, None, None
     
     
+# ============================================== Scheduling ================================================
+# Share one worker budget between model-level, fold-level and tree-level parallelism
+class scheduler:
+    def split_budget(n_models, k=5, n_jobs=-1):
+        '''
+        Split the available workers between concurrently trained models, their folds and their trees
+
+        Models run in a pool of processes, and the Parallel calls of a model run in a nested pool of processes
+        (see run): the custom models are Python loops holding the GIL, threads would not use the extra cores.
+        A model spends its share on its folds when it is cross-validated, or on its trees (or hyperparameter
+        search) when it is scored on a hold-out split. Trees of a cross-validated model are fitted sequentially
+        inside each fold, one level deeper joblib would fall back to threads.
+
+        Parameters
+        - n_models (int): Number of candidate models to schedule
+        - k (int): Number of cross-validation folds per model (default = 5)
+        - n_jobs (int): Total number of workers, joblib semantics (default = -1 for all processors)
+
+        Returns
+        - model_jobs (int): Number of models trained concurrently, in separate processes
+        - fold_jobs (int): Number of fold processes inside a cross-validated model
+        - tree_jobs (int): Number of tree processes inside a hold-out model
+        - blas_threads (int): Number of BLAS threads allowed in each worker
+        '''
+        total = effective_n_jobs(n_jobs)
+
+        model_jobs = max(1, min(n_models, total))
+        per_model = max(1, total // model_jobs)
+
+        fold_jobs = max(1, min(k, per_model))
+        tree_jobs = per_model
+
+        # Cores left over after the process-level split go to BLAS, otherwise every worker is single-threaded
+        blas_threads = max(1, total // (model_jobs * per_model))
+
+        return model_jobs, fold_jobs, tree_jobs, blas_threads
+
+    def apply_budget(model, n_jobs):
+        '''
+        Set the number of internal jobs on a model, or on every step of a Pipeline that supports it
+
+        Parameters
+        - model: Model instance or Pipeline
+        - n_jobs (int): Number of jobs the model may use internally
+        '''
+        for step in scheduler._steps(model):
+            if hasattr(step, 'n_jobs'):
+                step.n_jobs = n_jobs
+
+    def set_deadline(model, deadline):
+        '''
+        Set the deadline on a model, or on every step of a Pipeline that supports it
+
+        Parameters
+        - model: Model instance or Pipeline
+        - deadline (float): Absolute time (time.time()) at which training should stop, None for no deadline
+        '''
+        for step in scheduler._steps(model):
+            if hasattr(step, 'deadline'):
+                step.deadline = deadline
+
+    def stopped_early(model):
+        '''
+        Check whether a model, or any step of a Pipeline, stopped training early because of its deadline
+        '''
+        return any(getattr(step, 'stopped_early', False) for step in scheduler._steps(model))
+
+    def _steps(model):
+        return [step for _, step in model.steps] if isinstance(model, Pipeline) else [model]
+
+    def _run_limited(func, blas_threads, args):
+        '''
+        Run a task inside a worker with the number of BLAS threads capped, and the Parallel calls of the task in processes
+        '''
+        # Without an explicit backend joblib runs the Parallel calls of a process worker on threads
+        with threadpool_limits(limits=blas_threads), parallel_backend('loky'):
+            return func(*args)
+
+    def run(tasks, n_jobs=1, blas_threads=1):
+        '''
+        Run independent tasks concurrently from one pool of workers
+
+        Parameters
+        - tasks (list): List of (function, args) tuples
+        - n_jobs (int): Number of tasks running at the same time (default = 1)
+        - blas_threads (int): Number of BLAS threads allowed in each worker (default = 1)
+
+        Returns
+        - list: Results of the tasks, in the same order as the tasks
+        '''
+        return Parallel(n_jobs=n_jobs, backend='loky')(
+            delayed(scheduler._run_limited)(func, blas_threads, args)
+            for func, args in tasks
+        )
+
+
 # ============================================== Select Model ================================================
 # Select the best model class
 class select_model:
     # k-Fold Cross-Validation function
-    def cross_validation(model_class, X, y, k=5, mode='classification', n_jobs=-1):
+    def cross_validation(model_class, X, y, k=5, mode='classification', n_jobs=-1, fingerprint=None):
         '''
         Perform k-fold cross-validation for a given model and dataset with ROC-AUC curve score for classification,
         R^2 score for regression using joblib
@@ -1397,11 +1572,23 @@ class select_model:
         - k (int): Number of folds for cross-validation (default = 5)
         - mode (str): 'classification' or 'regression' (default = 'classification')
         - n_jobs (int): Number of jobs for parallel processing (default = -1)
+        - fingerprint (str): Dataset fingerprint used to reuse cached scores, None to disable the cache (default = None)
 
         Returns
-        - float: The average score across all folds
+        - tuple
+            - float: The average score across all folds
+            - bool: True if any fold stopped training early because of its deadline
         '''
         try:
+            key = None
+            if fingerprint is not None:
+                model_description = model_class() if isinstance(model_class, type) else model_class
+                key = cache_key(fingerprint, model_description, mode=mode, split='kfold', k=k, seed=42)
+                cached_score = score_cache.get(key)
+                if cached_score is not None:
+                    logger.info(f"Reusing cached cross-validation score for {model_class}: {cached_score: .4f}")
+                    return cached_score, False
+
             # Initialize k-fold cross-validation splitter
             skf = StratifiedKFold(n_splits=k, shuffle=True, random_state=42)
             logger.debug(f"Current model (cross_validation_joblib): {model_class}")
@@ -1421,139 +1608,261 @@ class select_model:
                 # Initialize the model
                 if isinstance(model_class, type):  # If it's a class
                     model = model_class()
-                else:  # If it's already an instance
-                    model = model_class
+                else:  # If it's already an instance, every fold trains its own copy
+                    model = copy.deepcopy(model_class)
                 
                 model.fit(train_X, train_y)
 
-                if mode == 'regression':
-                    predictions = model.predict(val_X)
-                    return r2_score(val_y, predictions)
-                elif mode == 'classification':
-                    prob_y = model.predict_proba(val_X)
-            
-                    if hasattr(model, "num_class") and model.num_class == 2:
-                        return roc_auc_score(val_y, prob_y[:, 1])
-                    else:
-                        return roc_auc_score(val_y, prob_y, multi_class='ovr', average='weighted')
+                return evaluation.score_model(model, val_X, val_y, mode=mode)['score'], scheduler.stopped_early(model)
             
-            scores = Parallel(n_jobs=n_jobs)(
+            results = Parallel(n_jobs=n_jobs)(
                 delayed(train_and_evaluate)(train_idx, val_idx)
                 for train_idx, val_idx in skf.split(X, y)
             )
+            scores = [score for score, _ in results]
+            stopped_early = any(stopped for _, stopped in results)
             
             avg_score = np.mean([score for score in scores if score is not None])        # Filter out failed folds
 
             logger.debug(f"Cross-validation results for all folds: {scores}")
 
-            return avg_score
+            # Scores of folds cut short by the deadline are not representative
+            if key is not None and not stopped_early:
+                score_cache.put(key, avg_score, str(model_class))
+
+            return avg_score, stopped_early
         except Exception as e:
             logger.error(f"Error during cross-validation with joblib: {e}")
-            return None
+            return None, False
+
+    # Models scored on a hold-out split instead of k-fold cross-validation
+    HOLDOUT_MODELS = [
+        'Decision Tree classification',
+        'Decision Tree regression',
+        'Random Forest classification',
+        'Random Forest regression',
+        'Tuned Logistic Regression'
+    ]
+
+    # Train a model on the hold-out split
+    def train_holdout(model_name, model, X, y):
+        '''
+        Fit a model on the training part of the 80/20 hold-out split
+
+        Parameters
+        - model_name (str): Name of the model
+        - model: Model instance or Pipeline to train
+        - X (numpy array or DataFrame): Feature matrix of shape (num_samples, num_features)
+        - y (Series): Target labels of shape (num_samples)
+
+        Returns
+        - test_X (DataFrame): Hold-out features
+        - test_y (Series): Hold-out labels
+        '''
+        if model_name == 'Tuned Logistic Regression':
+            logger.info(f"Applying scaler to Tuned Logistic Regression.")
+            scaler = StandardScaler()
+            X = scaler.fit_transform(X)
+
+        train_X, test_X, train_y, test_y = train_test_split(X, y, test_size=0.2, random_state=42)
+
+        train_X = pd.DataFrame(train_X).reset_index(drop=True)
+        test_X = pd.DataFrame(test_X).reset_index(drop=True)
+        train_y = train_y.reset_index(drop=True)
+        test_y = test_y.reset_index(drop=True)
+
+        model.fit(train_X, train_y)
+
+        return test_X, test_y
+
+    # Train and score a single candidate model
+    def evaluate_model(spec, X, y, mode='classification', k=5, fold_jobs=1, tree_jobs=1, deadline=None, fingerprint=None):
+        '''
+        Build, train and score one candidate model, either on a hold-out split or with k-fold cross-validation
+
+        Parameters
+        - spec (ModelSpec): Registry entry of the model to evaluate
+        - X (numpy array or DataFrame): Feature matrix of shape (num_samples, num_features)
+        - y (numpy array or Series): Target labels of shape (num_samples)
+        - mode (str): 'classification' or 'regression' (default = 'classification')
+        - k (int): Number of folds for cross-validation (default = 5)
+        - fold_jobs (int): Number of folds evaluated in parallel when the model is cross-validated (default = 1)
+        - tree_jobs (int): Number of jobs the model may use internally when it is scored on a hold-out split (default = 1)
+        - deadline (float): Absolute time (time.time()) by which the model should finish (default = None)
+        - fingerprint (str): Dataset fingerprint used to reuse cached scores, None to disable the cache (default = None)
+
+        Returns
+        - tuple
+            - model_name (str): Name of the model
+            - model: The model trained on the hold-out split, None if it was not trained in this run
+                (skipped, cached score or cross-validated)
+            - score (float): ROC-AUC score for classification, R^2 score for regression (None on failure)
+            - elapsed (float): Execution time in seconds
+            - status (str): 'completed', 'cached', 'stopped early' or 'skipped'
+        '''
+        model_name = spec.name
+        model = None
+        stopped_early = False
+
+        if deadline is not None and time.time() > deadline:
+            logger.info(f"Skipping model: {model_name} (time budget exhausted)")
+            return model_name, model, None, 0.0, 'skipped'
+
+        logger.info(f"Processing model: {model_name}")
+        model_start_time = time.time()
+
+        try:
+            if model_name in select_model.HOLDOUT_MODELS:
+                # Hold-out scores are cached per registry entry, so a hit also skips hyperparameter tuning
+                key = None
+                if fingerprint is not None:
+                    key = cache_key(fingerprint, spec.factory(), param_dist=spec.param_dist, mode=mode,
+                                    split='holdout', test_size=0.2, seed=42)
+                    score = score_cache.get(key)
+                    if score is not None:
+                        logger.info(f"[{model_name}] Reusing cached score: {score: .4f}")
+                        return model_name, None, score, time.time() - model_start_time, 'cached'
+
+                model = spec.build(X, y, n_jobs=tree_jobs, deadline=deadline)
+                if model is None and deadline is not None and time.time() > deadline:
+                    logger.info(f"Skipping model: {model_name} (time budget exhausted during tuning)")
+                    return model_name, None, None, time.time() - model_start_time, 'skipped'
+                scheduler.set_deadline(model, deadline)
+
+                # Hold-out models have no folds, so the whole per-model budget goes to the trees
+                scheduler.apply_budget(model, tree_jobs)
+                test_X, test_y = select_model.train_holdout(model_name, model, X, y)
+
+                score = evaluation.score_model(model, test_X, test_y, mode=mode)['score']
+                if mode == 'classification':
+                    logger.info(f"[{model_name}] Classification ROC-AUC score: {score: .4f}")
+                else:
+                    logger.info(f"[{model_name}] Regression R^2 score: {score: .4f}")
+                
+                logger.debug(f"{model_name} evaluation score: {score}")
+
+                # Scores of models cut short by the deadline are not representative
+                stopped_early = scheduler.stopped_early(model)
+                if key is not None and not stopped_early:
+                    score_cache.put(key, score, model_name)
+            
+            else:
+                # Perform cross-validation fro other models
+                logger.info(f"Scheduling cross-validation fro model: {model_name}")
+                cv_model = spec.build(X, y, n_jobs=fold_jobs, deadline=deadline)
+                scheduler.set_deadline(cv_model, deadline)
+                # The folds already use the model's share of processes, the trees inside a fold are fitted sequentially
+                scheduler.apply_budget(cv_model, 1)
+                score, stopped_early = select_model.cross_validation(cv_model, X, y, k, mode=mode, n_jobs=fold_jobs, fingerprint=fingerprint)
+                logger.debug(f"{model_name} cross-validation score: {score}")
+        
+        except Exception as e:
+            logger.error(f"Error evaluating model {model_name}: {e}")
+            score = None
+
+        elapsed = time.time() - model_start_time
+        status = 'stopped early' if stopped_early else 'completed'
+        return model_name, model, score, elapsed, status
+
+    # Fit the selected model when it was not trained during the selection
+    def refit(spec, X, y, n_jobs=-1):
+        '''
+        Train the selected model, on the hold-out training split for hold-out models, on the whole dataset otherwise.
+        The model is trained without a deadline: the selection deadline is usually spent by now, and a model cut short
+        at its first epoch or split would not match the score it was selected with
+
+        Parameters
+        - spec (ModelSpec): Registry entry of the selected model
+        - X (numpy array or DataFrame): Feature matrix of shape (num_samples, num_features)
+        - y (Series): Target labels of shape (num_samples)
+        - n_jobs (int): Number of jobs the model may use (default = -1)
+
+        Returns
+        - model: The trained model
+        '''
+        logger.info(f"Training the selected model: {spec.name}")
+        model = spec.build(X, y, n_jobs=n_jobs)
+        if model is None:
+            # The hyperparameter search failed, the model is trained with its default hyperparameters
+            model = spec.factory()
+        scheduler.apply_budget(model, n_jobs)
+
+        if spec.name in select_model.HOLDOUT_MODELS:
+            select_model.train_holdout(spec.name, model, X, y)
+        else:
+            model.fit(X, y)
+
+        return model
 
     # Model selection function
-    def model_selection(models, X, y, mode='classification', k=5):
+    def model_selection(models, X, y, mode='classification', k=5, n_jobs=-1, time_budget=None):
         '''
-        Seleect the best model for the given dataset using k-fold cross-validation and Dask for parallel computation
+        Seleect the best model for the given dataset using k-fold cross-validation, evaluating the candidate models
+        concurrently from one worker budget
 
         Parameters
-        - models (dict): Dictionary of models to be used
+        - models (list): Registry of candidate models (ModelSpec), only the ones applicable to the mode are built
         - X (numpy array or DataFrame): Feature matrix of shape (num_samples, num_features)
         - y (numpy array or Series): Target labels of shape (num_samples)
         - k (int): Number of folds for cross-validation (default=5)
+        - n_jobs (int): Total number of workers shared by all models (default = -1 for all processors)
+        - time_budget (float): Time budget in seconds, None for no limit (default = None)
+            Cheap models run first, expensive models stop early or are skipped when the deadline is reached,
+            and the best model found so far is returned
 
         Returns
         - tuple
             - best_model: The model with the best performance based on the ROC-AUC curve
             - best_score (float): The average score of the best model across all folds
+            - skipped_models (list): (model name, status) of the models skipped or stopped early by the time budget
         '''
         logger.info("Starting model selection...")
         start_time = time.time()
+        deadline = start_time + time_budget if time_budget is not None else None
         try:
             y_type = preprocess.check_target_type(y)
             if y_type == 'categorical':
                 y, label_map = preprocess.map_target(y)
             else:
                 y, label_map = y, None
+
+            # Scores are cached by dataset content, so repeated runs on the same file reuse them
+            score_cache.restore_from_s3()
+            fingerprint = dataset_fingerprint(X, y)
             
-            # Run all tasks in parallel
-            results = []
-            for model_name, model in models.items():
-                # Skip models that do not match the detected mode
-                if ('classification' in model_name and mode == 'regression') or \
-                ('regression' in model_name and mode == 'classification'):
-                    logger.info(f"Skipping model: {model_name} (not applicable for mode: {mode})")
+            candidates = []
+            for spec in models:
+                # Skip models that do not match the detected mode, they are never built
+                if not spec.applies_to(mode):
+                    logger.info(f"Skipping model: {spec.name} (not applicable for mode: {mode})")
                     continue
 
-                logger.info(f"Processing model: {model_name}")
-                model_start_time = time.time()
+                candidates.append(spec)
 
-                if model_name in [
-                    'Decision Tree classification',
-                    'Decision Tree regression',
-                    'Random Forest classification',
-                    'Random Forest regression',
-                    'Tuned Logistic Regression'
-                    ]:
+            # Run the cheap models first so a result is available early
+            candidates.sort(key=lambda spec: spec.cost)
 
-                    if model_name == 'Tuned Logistic Regression':
-                        logger.info(f"Applying scaler to Tuned Logistic Regression.")
-                        scaler = StandardScaler()
-                        X_scaled = scaler.fit_transform(X)
+            # Split the worker budget between models, folds and trees
+            model_jobs, fold_jobs, tree_jobs, blas_threads = scheduler.split_budget(len(candidates), k=k, n_jobs=n_jobs)
+            logger.info(f"Scheduling {len(candidates)} models with {model_jobs} model workers, {fold_jobs} fold workers, "
+                        f"{tree_jobs} tree workers and {blas_threads} BLAS threads per worker.")
 
-                        train_X, test_X, train_y, test_y = train_test_split(X_scaled, y, test_size=0.2, random_state=42)
+            # Run all tasks in parallel, the cheapest model always runs to completion so there is a result
+            tasks = [
+                (select_model.evaluate_model, (spec, X, y, mode, k, fold_jobs, tree_jobs, deadline if i > 0 else None, fingerprint))
+                for i, spec in enumerate(candidates)
+            ]
+            outcomes = scheduler.run(tasks, n_jobs=model_jobs, blas_threads=blas_threads)
 
-                        train_X = pd.DataFrame(train_X).reset_index(drop=True)
-                        test_X = pd.DataFrame(test_X).reset_index(drop=True)
-                        train_y = train_y.reset_index(drop=True)
-                        test_y = test_y.reset_index(drop=True)
+            results = []
+            skipped_models = []
+            for model_name, model, score, elapsed, status in outcomes:
+                logger.info(f"Model {model_name} {status}, score: {score}, execution time: {elapsed: .2f} seconds")
 
-                        model.fit(train_X, train_y)
-                    
-                    else:
-                        train_X, test_X, train_y, test_y = train_test_split(X, y, test_size=0.2, random_state=42)
-
-                        train_X = pd.DataFrame(train_X).reset_index(drop=True)
-                        test_X = pd.DataFrame(test_X).reset_index(drop=True)
-                        train_y = train_y.reset_index(drop=True)
-                        test_y = test_y.reset_index(drop=True)
-
-                        model.fit(train_X, train_y)
-
-                    if mode == 'classification':
-                        if isinstance(model, Pipeline):
-                            inner_model = None
-                            for step_name in ['Decision Tree classification', 'Decision Tree regression', 'Random Forest classification', 'Random Forest regression', 'Tuned Logistic Regression']:
-                                if step_name in model.named_steps:
-                                    inner_model = model.named_steps[step_name]
-                                    break
-                        else:
-                            inner_model = model
-
-                        prob_y = model.predict_proba(test_X)
-                        if hasattr(inner_model, 'num_class') and inner_model.num_class == 2:
-                            score = roc_auc_score(test_y, prob_y)
-                            logger.info(f"[{model_name}] Classification ROC-AUC score (binary): {score: .4f}")
-                        else:
-                            score = roc_auc_score(test_y, prob_y, multi_class='ovr', average='weighted')
-                            logger.info(f"[{model_name}] Classification ROC-AUC score (multi-class): {score: .4f}")
-                    else:
-                        predictions = model.predict(test_X)
-                        score = r2_score(test_y, predictions)
-                        logger.info(f"[{model_name}] Regression R^2 score: {score: .4f}")
-                    
-                    logger.debug(f"{model_name} evaluation score: {score}")
-                    results.append((model_name, model, score))
-                
-                else:
-                    # Perform cross-validation fro other models
-                    logger.info(f"Scheduling cross-validation fro model: {model_name}")
-                    score = select_model.cross_validation(model, X, y, k, mode=mode)
+                if status in ('skipped', 'stopped early'):
+                    skipped_models.append((model_name, status))
+                if status != 'skipped':
                     results.append((model_name, model, score))
-                    logger.debug(f"{model_name} cross-validation score: {score}")
-                
-                model_end_time = time.time() - model_start_time
-                logger.info(f"Model {model_name} execution time: {model_end_time: .2f} seconds")
 
             # Find the best model based on score
             used_model_name = []
@@ -1566,151 +1875,474 @@ class select_model:
                     best_score = score
                     best_model = model
                     best_model_name = model_name
+
+            # The best model was scored from the cache or by cross-validation, so it still has to be trained
+            if best_model is None and best_model_name is not None:
+                best_spec = next(spec for spec in candidates if spec.name == best_model_name)
+                best_model = select_model.refit(best_spec, X, y, n_jobs=n_jobs)
+
+            score_cache.persist_to_s3()
             
             total_time = time.time() - start_time
             logger.info(f"Best Model: {best_model}, Best Score: {best_score: .4f}")
             logger.info(f"Model selection completed in {total_time: .2f} seconds.")
             
-            return best_model_name, used_model_name, best_model, best_score, label_map, y_type
+            if skipped_models:
+                logger.info(f"Models affected by the time budget: {skipped_models}")
+            
+            return best_model_name, used_model_name, best_model, best_score, label_map, y_type, skipped_models
         
         except Exception as e:
-            logger.error(f"Error during model selection {model_name}: {e}")
-            return None, None, None, None, None, None
+            logger.error(f"Error during model selection: {e}")
+            return None, None, None, None, None, None, None
 
 
 # ============================================== Evaluation ================================================
 # Model evaluation functions
 class evaluation:
+    def _safe_divide(numerator, denominator):
+        '''
+        Element-wise division returning 0 where the denominator is 0, works on scalars and arrays
+        '''
+        numerator = np.asarray(numerator, dtype=float)
+        denominator = np.asarray(denominator, dtype=float)
+        result = np.divide(numerator, denominator, out=np.zeros(np.broadcast(numerator, denominator).shape), where=denominator != 0)
+        return result.item() if result.ndim == 0 else result
+
     def evaluate_classifier(TP, TN, FP, FN):
-        sensitivity = 0 if (TP + FN) == 0 else TP / (TP + FN)
-        specificity = 0 if (TN + FP) == 0 else TN / (TN + FP)
-        precision = 0 if (TP + FP) == 0 else TP / (TP + FP)
-        npv = 0 if (TN + FN) == 0 else TN / (TN + FN)
-        accuracy = 0 if (TP + TN + FP + FN) == 0 else (TP + TN) / (TP + TN + FP + FN)
-        f_score = 0 if (precision + sensitivity) == 0 else 2 * precision * sensitivity / (precision + sensitivity)
+        sensitivity = evaluation._safe_divide(TP, TP + FN)
+        specificity = evaluation._safe_divide(TN, TN + FP)
+        precision = evaluation._safe_divide(TP, TP + FP)
+        npv = evaluation._safe_divide(TN, TN + FN)
+        accuracy = evaluation._safe_divide(np.add(TP, TN), np.add(TP, TN) + np.add(FP, FN))
+        f_score = evaluation._safe_divide(2 * np.multiply(precision, sensitivity), np.add(precision, sensitivity))
         return sensitivity, specificity, precision, npv, accuracy, f_score
 
+    def confusion_matrix(test_labels, pred_labels, label, include_unknown=False):
+        '''
+        Build the confusion matrix with a single bincount
+
+        Parameters
+        - test_labels (array-like): True labels
+        - pred_labels (array-like): Predicted labels
+        - label (list): Labels, in the order of the matrix rows and columns
+        - include_unknown (bool): If True, keep an extra last column counting predictions outside label (default = False)
+
+        Returns
+        - numpy array: Matrix of shape (num_labels, num_labels), or (num_labels, num_labels + 1) with include_unknown,
+            rows are true labels, columns are predicted labels. Rows whose true label is not in label are ignored
+        '''
+        label_index = pd.Index(list(label))
+        k = len(label_index)
+
+        true_idx = label_index.get_indexer(np.asarray(test_labels).ravel())
+        pred_idx = label_index.get_indexer(np.asarray(pred_labels).ravel())
+
+        # Unknown predictions go to an extra column that is dropped afterwards
+        valid = true_idx >= 0
+        pred_idx = np.where(pred_idx >= 0, pred_idx, k)
+
+        counts = np.bincount(true_idx[valid] * (k + 1) + pred_idx[valid], minlength=k * (k + 1)).reshape(k, k + 1)
+        return counts if include_unknown else counts[:, :k]
+
+    def counts_from_matrix(matrix):
+        '''
+        Derive the one-vs-rest tp, tn, fp and fn counts of every label from the confusion matrix
+
+        Parameters
+        - matrix (numpy array): Confusion matrix from confusion_matrix (an extra last column of unknown predictions
+            counts as false negatives), or a metrics dictionary from calculate_metrics
+
+        Returns
+        - tp, tn, fp, fn (numpy arrays): Counts per label
+        '''
+        if isinstance(matrix, dict):
+            counts = np.array([[m['tp'], m['tn'], m['fp'], m['fn']] for m in matrix.values()]).reshape(-1, 4)
+            return counts[:, 0], counts[:, 1], counts[:, 2], counts[:, 3]
+
+        matrix = np.asarray(matrix)
+        k = matrix.shape[0]
+        total = matrix.sum()
+        tp = np.diag(matrix[:, :k])
+        fn = matrix.sum(axis=1) - tp    # True label, predicted as something else (including unknown labels)
+        fp = matrix[:, :k].sum(axis=0) - tp
+        tn = total - tp - fn - fp
+        return tp, tn, fp, fn
+
     def calculate_metrics(test_labels, pred_labels, label):
-        metrics = {l: {'tp': 0, 'tn': 0, 'fp': 0, 'fn': 0} for l in label}
-        for true_label, predicted_label in zip(test_labels, pred_labels):
-            if isinstance(true_label, np.ndarray):
-                true_label = true_label.item() if true_label.size == 1 else tuple(true_label)
-
-            if true_label in label:
-                if predicted_label == true_label:
-                    metrics[true_label]['tp'] += 1
-                else:
-                    metrics[true_label]['fn'] += 1
-                for l in label:
-                    if l != true_label:
-                        if predicted_label == l:
-                            metrics[l]['fp'] += 1
-                        else:
-                            metrics[l]['tn'] += 1
+        matrix = evaluation.confusion_matrix(test_labels, pred_labels, label, include_unknown=True)
+        tp, tn, fp, fn = evaluation.counts_from_matrix(matrix)
+        metrics = {l: {'tp': int(tp[i]), 'tn': int(tn[i]), 'fp': int(fp[i]), 'fn': int(fn[i])} for i, l in enumerate(label)}
                     
         return metrics
 
     def macro_average(metrics):
-        precision_sum = 0
-        sensitivity_sum = 0
-        specificity_sum = 0
-        f1_score_sum = 0
-
-        for class_label, metric in metrics.items():
-            TN = metric['tn']
-            TP = metric['tp']
-            FP = metric['fp']
-            FN = metric['fn']
-            precision = 0 if (TP + FP) == 0 else TP / (TP + FP)
-            sensitivity = 0 if (TP + FN) == 0 else TP / (TP + FN)
-            specificity = 0 if (TN + FP) == 0 else TN / (TN + FP)
-            f1_score = 0 if (precision + sensitivity) == 0 else 2 * precision * sensitivity / (precision + sensitivity)
-            precision_sum += precision
-            sensitivity_sum += sensitivity
-            specificity_sum += specificity
-            f1_score_sum += f1_score
-
-        num_classes = len(metrics)
-        macro_precision = precision_sum / num_classes
-        macro_sensitivity = sensitivity_sum / num_classes
-        macro_specificity = specificity_sum / num_classes
-        macro_f1_score = f1_score_sum / num_classes
+        tp, tn, fp, fn = evaluation.counts_from_matrix(metrics)
+
+        precision = evaluation._safe_divide(tp, tp + fp)
+        sensitivity = evaluation._safe_divide(tp, tp + fn)
+        specificity = evaluation._safe_divide(tn, tn + fp)
+        f1_score = evaluation._safe_divide(2 * precision * sensitivity, precision + sensitivity)
+
+        macro_precision = precision.mean()
+        macro_sensitivity = sensitivity.mean()
+        macro_specificity = specificity.mean()
+        macro_f1_score = f1_score.mean()
         return macro_precision, macro_sensitivity, macro_specificity, macro_f1_score
 
     def micro_average(metrics):
-        sum_TN = sum([metric['tn'] for metric in metrics.values()])
-        sum_TP = sum([metric['tp'] for metric in metrics.values()])
-        sum_FP = sum([metric['fp'] for metric in metrics.values()])
-        sum_FN = sum([metric['fn'] for metric in metrics.values()])
+        tp, tn, fp, fn = evaluation.counts_from_matrix(metrics)
+        sum_TP, sum_TN, sum_FP, sum_FN = tp.sum(), tn.sum(), fp.sum(), fn.sum()
         
-        micro_precision = 0 if (sum_TP + sum_FP) == 0 else sum_TP / (sum_TP + sum_FP)
-        micro_sensitivity = 0 if (sum_TP + sum_FN) == 0 else sum_TP / (sum_TP + sum_FN)
-        micro_specificity = 0 if (sum_TN + sum_FP) == 0 else sum_TN / (sum_TN + sum_FP)
-        micro_f1_score = 0 if (micro_precision + micro_sensitivity) == 0 else 2 * micro_precision * micro_sensitivity / (micro_precision + micro_sensitivity)
+        micro_precision = evaluation._safe_divide(sum_TP, sum_TP + sum_FP)
+        micro_sensitivity = evaluation._safe_divide(sum_TP, sum_TP + sum_FN)
+        micro_specificity = evaluation._safe_divide(sum_TN, sum_TN + sum_FP)
+        micro_f1_score = evaluation._safe_divide(2 * micro_precision * micro_sensitivity, micro_precision + micro_sensitivity)
 
         return micro_precision, micro_sensitivity, micro_specificity, micro_f1_score
 
-def build_model_dict(X, y):
-    '''
-    Build the models dictionary to use model_selection
+    # Rows scored at once, larger test sets are evaluated chunk by chunk with a MetricsAccumulator
+    EVAL_CHUNK_SIZE = 100000
 
-    Parameters
-    - X (DataFrame): Input feature
-    - y (DataFrame or Series): Input labels
+    class MetricsAccumulator:
+        def __init__(self, mode='classification', labels=None, n_bins=1000):
+            '''
+            Mergeable metrics accumulated chunk by chunk, with memory independent of the number of rows
 
-    Returns
-    - models (dict): Dictionary of the models
-    '''
-    dt_classification = numeric.DecisionTree(mode='classification')
-    dt_regression = numeric.DecisionTree(mode='regression')
+            Parameters
+            - mode (str): 'classification' or 'regression' (default = 'classification')
+            - labels (list): All class labels, in the order of the predict_proba columns (classification only)
+            - n_bins (int): Number of score bins used to approximate the ROC-AUC (default = 1000)
 
-    # Use Pipeline
-    rf_classification_pipeline = Pipeline(steps=[
-        ('scaler', StandardScaler()),
-        ('rf_model', numeric.RandomForest(mode='classification'))
-    ])
+            Attributes
+            - matrix (numpy array): Confusion counts, with an extra last column for predictions outside labels
+            - pos_hist, neg_hist (numpy arrays): Binned scores of the positive and negative rows of each class
+            - sum_y, sum_y2, sse (float): Sums used for the R^2 score
+            '''
+            self.mode = mode
+            self.labels = list(labels) if labels is not None else []
+            self.n_bins = n_bins
+            self.n = 0
+            self.n_correct = 0
 
-    rf_regression_pipeline = Pipeline(steps=[
-        ('scaler', StandardScaler()),
-        ('rf_model', numeric.RandomForest(mode='regression'))
-    ])
+            k = len(self.labels)
+            self.matrix = np.zeros((k, k + 1), dtype=np.int64)
+            self.pos_hist = np.zeros((k, n_bins), dtype=np.int64)
+            self.neg_hist = np.zeros((k, n_bins), dtype=np.int64)
 
-    logistic_pipeline = Pipeline(steps=[
-        ('scaler', StandardScaler()),
-        ('logistic_model', numeric.LogisticRegression())
-    ])
+            self.sum_y = 0.0
+            self.sum_y2 = 0.0
+            self.sse = 0.0
 
-    # Logistic Regression hyperparameters tuning
-    logi_model = numeric.LogisticRegression()
+        def update(self, y_true, y_pred, y_score=None):
+            '''
+            Add one chunk of predictions
+
+            Parameters
+            - y_true (array-like): True labels or values of the chunk
+            - y_pred (array-like): Predicted labels or values of the chunk
+            - y_score (array-like): Class probabilities of the chunk, shape (num_samples, num_labels),
+                or the positive class probability for binary classification (default = None)
+            '''
+            y_true = np.asarray(y_true).ravel()
+            y_pred = np.asarray(y_pred).ravel()
+
+            self.n += len(y_true)
+            self.n_correct += int(np.sum(y_true == y_pred))
+
+            if self.mode == 'regression':
+                y_true = y_true.astype(float)
+                self.sum_y += y_true.sum()
+                self.sum_y2 += np.square(y_true).sum()
+                self.sse += np.square(y_true - y_pred.astype(float)).sum()
+                return
+
+            self.matrix += evaluation.confusion_matrix(y_true, y_pred, self.labels, include_unknown=True)
+
+            if y_score is None:
+                return
+
+            k = len(self.labels)
+            y_score = np.asarray(y_score, dtype=float)
+            if y_score.ndim == 1:
+                y_score = np.column_stack((1 - y_score, y_score))
+
+            # Histogram every (row, class) score in one bincount, split by whether the row belongs to the class
+            true_idx = pd.Index(self.labels).get_indexer(y_true)
+            bins = np.clip((y_score[:, :k] * self.n_bins).astype(np.int64), 0, self.n_bins - 1)
+            flat = np.arange(k) * self.n_bins + bins
+            is_pos = true_idx[:, None] == np.arange(k)
+
+            self.pos_hist += np.bincount(flat[is_pos], minlength=k * self.n_bins).reshape(k, self.n_bins)
+            self.neg_hist += np.bincount(flat[~is_pos], minlength=k * self.n_bins).reshape(k, self.n_bins)
+
+        def merge(self, other):
+            '''
+            Merge the counts of another accumulator, e.g. from another worker or fold
+
+            Parameters
+            - other (MetricsAccumulator): Accumulator with the same mode, labels and bins
+
+            Returns
+            - MetricsAccumulator: self
+            '''
+            if other.mode != self.mode or other.labels != self.labels or other.n_bins != self.n_bins:
+                error_message = "Cannot merge metrics accumulators with different mode, labels or bins."
+                logger.error(error_message)
+                raise ValueError(error_message)
+
+            self.n += other.n
+            self.n_correct += other.n_correct
+            self.matrix += other.matrix
+            self.pos_hist += other.pos_hist
+            self.neg_hist += other.neg_hist
+            self.sum_y += other.sum_y
+            self.sum_y2 += other.sum_y2
+            self.sse += other.sse
+            return self
+
+        def accuracy(self):
+            return evaluation._safe_divide(self.n_correct, self.n)
+
+        def r2(self):
+            total_sum_squares = self.sum_y2 - self.sum_y ** 2 / self.n if self.n else 0.0
+            return 1 - evaluation._safe_divide(self.sse, total_sum_squares)
+
+        def f1(self):
+            '''
+            F1 score weighted by the support of each class
+            '''
+            tp, tn, fp, fn = evaluation.counts_from_matrix(self.matrix)
+            precision = evaluation._safe_divide(tp, tp + fp)
+            sensitivity = evaluation._safe_divide(tp, tp + fn)
+            f1_score = evaluation._safe_divide(2 * precision * sensitivity, precision + sensitivity)
+            return evaluation._safe_divide(np.sum(f1_score * (tp + fn)), np.sum(tp + fn))
+
+        def roc_auc(self):
+            '''
+            Approximate ROC-AUC from the binned scores, of the positive class for binary classification,
+            one-vs-rest weighted by support otherwise
+            '''
+            positives = self.pos_hist.sum(axis=1)
+            negatives = self.neg_hist.sum(axis=1)
+
+            # Probability that a positive row scores above a negative one, ties within a bin count half
+            negatives_below = np.cumsum(self.neg_hist, axis=1) - self.neg_hist
+            wins = np.sum(self.pos_hist * (negatives_below + 0.5 * self.neg_hist), axis=1)
+            auc = evaluation._safe_divide(wins, positives * negatives)
+
+            if len(self.labels) == 2:
+                return float(auc[1])
+            return evaluation._safe_divide(np.sum(auc * positives), np.sum(positives))
 
+    def _score_chunk(model, X, y, mode, labels, start, end):
+        '''
+        Predict one chunk of rows and return its MetricsAccumulator
+        '''
+        chunk_X = X.iloc[start:end] if isinstance(X, pd.DataFrame) else X[start:end]
+        chunk_y = y[start:end]
+
+        accumulator = evaluation.MetricsAccumulator(mode=mode, labels=labels)
+        y_score = np.asarray(model.predict_proba(chunk_X)) if mode == 'classification' else None
+        accumulator.update(chunk_y, model.predict(chunk_X), y_score)
+        return accumulator
+
+    def model_labels(model, y):
+        '''
+        Class labels of a trained model, in the order of its predict_proba columns
+
+        Parameters
+        - model: Trained model or Pipeline
+        - y (numpy array): Test labels, only used when the model does not record its classes
+
+        Returns
+        - list: Class labels
+        '''
+        step = model.steps[-1][1] if isinstance(model, Pipeline) else model
+
+        if hasattr(step, 'classes_'):
+            return list(step.classes_)
+        if getattr(step, 'classes', None):
+            return sorted(step.classes)
+        if getattr(step, 'num_class', None):
+            return list(range(step.num_class))
+        return sorted(np.unique(y))
+
+    def ovr_roc_auc(y, y_score, labels):
+        '''
+        ROC-AUC of the positive class for binary classification, one-vs-rest weighted by support otherwise.
+        Classes missing from y are left out instead of shifting the predict_proba columns
+
+        Parameters
+        - y (numpy array): True labels
+        - y_score (numpy array): Class probabilities, shape (num_samples, len(labels))
+        - labels (list): Class labels, in the order of the y_score columns
+
+        Returns
+        - float: ROC-AUC score (0 when no class has both positive and negative rows)
+        '''
+        columns = [1] if len(labels) == 2 else range(len(labels))
+
+        aucs, supports = [], []
+        for i in columns:
+            positive = y == labels[i]
+            if 0 < positive.sum() < len(y):
+                aucs.append(roc_auc_score(positive, y_score[:, i]))
+                supports.append(positive.sum())
+
+        return float(np.average(aucs, weights=supports)) if aucs else 0.0
+
+    def score_model(model, X, y, mode='classification', chunk_size=None, n_jobs=1):
+        '''
+        Score a trained model on a test set. Test sets up to chunk_size rows are scored exactly at once,
+        larger ones chunk by chunk (possibly in parallel) with merged MetricsAccumulators
+
+        Parameters
+        - model: Trained model
+        - X (numpy array or DataFrame): Test features
+        - y (numpy array or Series): Test labels or values
+        - mode (str): 'classification' or 'regression' (default = 'classification')
+        - chunk_size (int): Number of rows scored at once (default = None, use EVAL_CHUNK_SIZE)
+        - n_jobs (int): Number of chunks scored in parallel (default = 1)
+
+        Returns
+        - dict: 'accuracy', 'f1' and 'roc_auc' for classification, 'accuracy' and 'r2' for regression,
+            and 'score' (ROC-AUC for classification, R^2 for regression)
+        '''
+        if chunk_size is None:
+            chunk_size = evaluation.EVAL_CHUNK_SIZE
+
+        y = np.asarray(y).ravel()
+        # The labels come from the model, a test fold may miss some of its classes
+        labels = evaluation.model_labels(model, y) if mode == 'classification' else None
+
+        if len(y) <= chunk_size:
+            predictions = np.asarray(model.predict(X)).ravel()
+            metrics = {'accuracy': float(np.mean(predictions == y))}
+
+            if mode == 'regression':
+                metrics['r2'] = metrics['score'] = r2_score(y, predictions)
+                return metrics
+
+            prob_y = np.asarray(model.predict_proba(X), dtype=float)
+            if prob_y.ndim == 1:
+                prob_y = np.column_stack((1 - prob_y, prob_y))
+            metrics['f1'] = f1_score(y, predictions, average='weighted')
+            metrics['roc_auc'] = metrics['score'] = evaluation.ovr_roc_auc(y, prob_y, labels)
+            return metrics
+
+        accumulators = Parallel(n_jobs=n_jobs)(
+            delayed(evaluation._score_chunk)(model, X, y, mode, labels, start, min(start + chunk_size, len(y)))
+            for start in range(0, len(y), chunk_size)
+        )
+
+        accumulator = accumulators[0]
+        for other in accumulators[1:]:
+            accumulator.merge(other)
+
+        metrics = {'accuracy': accumulator.accuracy()}
+        if mode == 'regression':
+            metrics['r2'] = metrics['score'] = accumulator.r2()
+        else:
+            metrics['f1'] = accumulator.f1()
+            metrics['roc_auc'] = metrics['score'] = accumulator.roc_auc()
+        return metrics
+
+
+# ============================================== Model Registry ================================================
+# Model factories tagged with the task they apply to and their relative training cost
+class ModelSpec:
+    def __init__(self, name, factory, tasks, cost, param_dist=None):
+        '''
+        Describe a candidate model without building it
+
+        Parameters
+        - name (str): Name of the model
+        - factory (callable): Function returning a new, untrained model
+        - tasks (tuple): Tasks the model applies to, 'classification' and/or 'regression'
+        - cost (int): Relative training cost, used to schedule the cheap models first
+        - param_dist (dict): Search space for hyperparameter tuning, None to use the model as built (default = None)
+        '''
+        self.name = name
+        self.factory = factory
+        self.tasks = tasks
+        self.cost = cost
+        self.param_dist = param_dist
+
+    def applies_to(self, mode):
+        return mode in self.tasks
+
+    def build(self, X, y, n_jobs=-1, deadline=None):
+        '''
+        Build the model, tuning its hyperparameters first if a search space is given
+
+        Parameters
+        - X (numpy array or DataFrame): Input features, used for tuning
+        - y (numpy array or Series): Input labels, used for tuning
+        - n_jobs (int): Number of jobs for the hyperparameter search (default = -1)
+        - deadline (float): Absolute time (time.time()) at which the search stops, None for no deadline (default = None)
+
+        Returns
+        - model: The untrained or tuned model (None if tuning failed or the deadline has passed)
+        '''
+        model = self.factory()
+
+        if self.param_dist is not None:
+            _, _, model = tuning.tune_hyperparameters(
+                model=model,
+                param_dist=self.param_dist,
+                X=X,
+                y=y,
+                n_iter=50,
+                cv=3,
+                random_state=42,
+                n_jobs=n_jobs,
+                deadline=deadline
+            )
+
+        return model
+
+
+def build_model_registry():
+    '''
+    Build the registry of candidate models to use model_selection
+    Models are only built (and tuned) when model_selection schedules them
+
+    Returns
+    - registry (list): List of ModelSpec
+    '''
+    # Logistic Regression hyperparameters tuning
     param_dist = {
                     'L2': uniform(0.01, 10),
                     'learning_rate': uniform(0.0001, 0.01),
                     'penalty': ['12'],
                     'solver': ['lbfgs', 'liblinear']
                 }
-    
-    LR_best_params, metrics, tuned_logistic = tuning.tune_hyperparameters(
-            model=logi_model,
-            param_dist=param_dist,
-            X=X,
-            y=y,
-            n_iter=50,
-            cv=3,
-            random_state=42
-        )
-    
-    models = {
-        'Naive Bayes': numeric.gausian_NaiveBayes(),
-        'Decision Tree classification': dt_classification,
-        'Decision Tree regression': dt_regression,
-        'Random Forest classification': rf_classification_pipeline,
-        'Random Forest regression': rf_regression_pipeline,
-        'Logistic Regression': logistic_pipeline,
-        'Tuned Logistic Regression': tuned_logistic
-    }
 
-    return models, LR_best_params, metrics
+    registry = [
+        ModelSpec('Naive Bayes', lambda: numeric.gausian_NaiveBayes(), tasks=('classification',), cost=1),
+        ModelSpec('Decision Tree classification', lambda: numeric.DecisionTree(mode='classification'),
+                  tasks=('classification',), cost=5),
+        ModelSpec('Decision Tree regression', lambda: numeric.DecisionTree(mode='regression'),
+                  tasks=('regression',), cost=5),
+        # Use Pipeline
+        ModelSpec('Random Forest classification', lambda: Pipeline(steps=[
+                    ('scaler', StandardScaler()),
+                    ('rf_model', numeric.RandomForest(mode='classification'))
+                  ]), tasks=('classification',), cost=20),
+        ModelSpec('Random Forest regression', lambda: Pipeline(steps=[
+                    ('scaler', StandardScaler()),
+                    ('rf_model', numeric.RandomForest(mode='regression'))
+                  ]), tasks=('regression',), cost=20),
+        ModelSpec('Logistic Regression', lambda: Pipeline(steps=[
+                    ('scaler', StandardScaler()),
+                    ('logistic_model', numeric.LogisticRegression())
+                  ]), tasks=('classification',), cost=2),
+        ModelSpec('Tuned Logistic Regression', lambda: numeric.LogisticRegression(),
+                  tasks=('classification',), cost=10, param_dist=param_dist)
+    ]
+
+    return registry
 
 
 class BestModel:
@@ -1779,24 +2411,19 @@ def individual_model(model_choice, X, y, mode='classification'):
     logger.info(f"Evaluating {model_choice}...")
 
     try:
-        predictions = model.predict(test_X)
+        # Large test sets are predicted and scored chunk by chunk
+        metrics = evaluation.score_model(model, test_X, test_y, mode=mode)
     except Exception as e:
         logger.error(f"Error predicting with {model_choice}: {e}")
         raise
 
-    accuracy = accuracy_score(test_y, predictions)
+    accuracy = metrics['accuracy']
+    score = metrics['score']
 
     if mode == 'regression':      # Regression
-        score = r2_score(test_y, predictions)
         logger.info(f"[{model_choice}] Regression R^2 score: {score: .4f}")
     else:               # Classification
-        prob_y = model.predict_proba(test_X)
-        if hasattr(model, 'num_class') and model.num_class == 2:
-            score = roc_auc_score(test_y, prob_y)
-            logger.info(f"[{model_choice}] Classification ROC-AUC score (binary): {score: .4f}")
-        else:
-            score = roc_auc_score(test_y, prob_y, multi_class='ovr', average='weighted')
-            logger.info(f"[{model_choice}] Classification ROC-AUC score (multi-class): {score: .4f}")
+        logger.info(f"[{model_choice}] Classification ROC-AUC score: {score: .4f}")
     
     logger.info(f"{model_choice} evaluation completed with accuracy: {accuracy: .4f}, score: {score: .4f}")
     
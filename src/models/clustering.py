@@ -1,40 +1,130 @@
 # Load libraries
+import io
 import pandas as pd
-from .common import spark, spark_processing, pandas_processing
+from .common import spark, spark_processing, pandas_processing, ROW_ID
 import numpy as np
 import seaborn as sns
-import matplotlib.pyplot as plt
 import matplotlib
-from sklearn.decomposition import PCA
-from sklearn.cluster import KMeans
-from sklearn.metrics import silhouette_score
-from sklearn.cluster import AgglomerativeClustering
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from sklearn.decomposition import PCA, IncrementalPCA
+from sklearn.utils import gen_batches
+from sklearn.random_projection import SparseRandomProjection, johnson_lindenstrauss_min_dim
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from sklearn.metrics import pairwise_distances, pairwise_distances_argmin_min
+from sklearn.cluster import AgglomerativeClustering, DBSCAN
+from sklearn.neighbors import NearestNeighbors, kneighbors_graph
+from pyspark.sql import DataFrame as SparkDataFrame
+from pyspark.sql import functions as F
+from pyspark.sql.types import DoubleType, FloatType, IntegerType, LongType, StructType, StructField
+from pyspark.ml.feature import VectorAssembler, PCA as sparkPCA
+from pyspark.ml.functions import vector_to_array
+from pyspark.ml.stat import Correlation
+from pyspark.ml.clustering import KMeans as sparkKMeans, BisectingKMeans
+from pyspark.ml.evaluation import ClusteringEvaluator
 
 matplotlib.use('Agg')
 
+# Above this number of rows, k-Means switches to mini-batch k-Means streamed over the rows
+LARGE_DATA_ROWS = 100000
+
+# Above this number of numeric columns, filter_data first reduces the data with a sparse random projection
+WIDE_DATA_COLUMNS = 1000
+
+# Distortion of the squared pairwise distances allowed by the random projection (Johnson-Lindenstrauss lemma)
+RANDOM_PROJECTION_EPS = 0.5
+
+# Above this number of points, the cluster plots draw a stratified sample instead of every point
+PLOT_MAX_POINTS = 5000
+
+# Above this number of rows, Agglomerative clustering builds the hierarchy on representatives and assigns the other rows
+AGGLOMERATIVE_MAX_ROWS = 10000
+
+# Memory allowed for one block of pairwise distances in the silhouette computation (bytes)
+SILHOUETTE_BLOCK_BYTES = 256 * 1024 ** 2
+
 # Functions
+# New figure on its own Agg canvas, independent from the pyplot global state shared by the requests of a worker
+def new_figure():
+    figure = Figure()
+    FigureCanvasAgg(figure)
+    return figure
+
+# Numeric columns of a Spark DataFrame, without the row id used to join the results back
+def spark_numeric_columns(data):
+    return [field.name for field in data.schema.fields
+            if isinstance(field.dataType, (DoubleType, FloatType, IntegerType, LongType)) and field.name != ROW_ID]
+
+# Assemble the numeric columns of a Spark DataFrame into a vector column, next to the row id
+def spark_features(data, output_col="features"):
+    assembler = VectorAssembler(inputCols=spark_numeric_columns(data), outputCol=output_col)
+    return assembler.transform(data).select(ROW_ID, output_col)
+
+# Greedy pass over a correlation matrix, a column is kept if it is not correlated above the threshold with a column kept before it
+def greedy_keep(corr, threshold, candidate=None):
+    kept = []
+    for j in range(corr.shape[0]):
+        if (candidate is None or candidate[j]) and not (corr[kept, j] > threshold).any():
+            kept.append(j)
+    
+    return kept
+
+# Columns correlated above the threshold with an earlier kept column, from a standardized float32 matrix in column blocks
+def correlated_columns(data, threshold=0.8, block_size=256):
+    X = np.asarray(data, dtype=np.float32)
+    n_rows, n_columns = X.shape
+
+    # Standardize so that Z.T @ Z is the Pearson correlation, a constant column has no correlation with any other
+    mean = X.mean(axis=0, dtype=np.float64)
+    std = X.std(axis=0, dtype=np.float64)
+    Z = np.asfortranarray((X - mean.astype(np.float32)) / np.where(std > 0, std * np.sqrt(n_rows), 1).astype(np.float32))
+    Z[:, std == 0] = 0
+
+    kept_blocks = []
+    dropped = []
+    for start in range(0, n_columns, block_size):
+        end = min(start + block_size, n_columns)
+        block = Z[:, start:end]
+        candidate = np.ones(end - start, dtype=bool)
+
+        # Compare with the kept columns of the previous blocks only, dropped columns are skipped
+        for kept in kept_blocks:
+            if not candidate.any():
+                break
+            corr = Z[:, kept].T @ block[:, candidate]
+            index = np.flatnonzero(candidate)
+            candidate[index[(corr > threshold).any(axis=0)]] = False
+        
+        # Greedy pass inside the block
+        kept_in_block = greedy_keep(block.T @ block, threshold, candidate)
+        dropped.extend(start + j for j in sorted(set(range(end - start)) - set(kept_in_block)))
+        
+        if kept_in_block:
+            kept_blocks.append(start + np.asarray(kept_in_block))
+    
+    return [data.columns[j] for j in dropped]
+
 # Find the useful variables to cluster
 def eliminate_high_correlation(data, threshold=0.8):
     # Eliminate the highly correlated features
     
     if isinstance(data, pd.DataFrame):
-        corr_matrix = data.corr()
-        upper_triangle = corr_matrix.where(np.triu(np.ones(corr_matrix.shape), k = 1).astype(bool))
-        to_drop = [column for column in upper_triangle.columns if any(upper_triangle[column] > threshold)]
+        to_drop = correlated_columns(data.select_dtypes(include='number'), threshold=threshold)
         return data.drop(columns = to_drop)
     
-    elif isinstance(data, spark.sql.dataframe.DataFrame):
-        columns = data.columns
-        to_drop = set()  # Set the stored the eliminated columns
+    elif isinstance(data, SparkDataFrame):
+        columns = spark_numeric_columns(data)
+        if len(columns) < 2:
+            return data
+
+        # Compute the whole Pearson matrix in one Spark job over an assembled vector column
+        assembler = VectorAssembler(inputCols=columns, outputCol="correlation_features", handleInvalid="skip")
+        vectors = assembler.transform(data).select("correlation_features")
+        corr_matrix = Correlation.corr(vectors, "correlation_features", "pearson").head()[0].toArray()
 
-        # Calculate the correlation between each column
-        for i in range(len(columns)):
-            for j in range(i + 1, len(columns)):
-                col1, col2 = columns[i], columns[j]
-                corr_value = data.stat.corr(col1, col2)
-                if corr_value > threshold:
-                    # Add highly correlated columns to the list to be removed
-                    to_drop.add(col2)
+        # Same greedy rule as the pandas path, on the driver: a column is dropped only when it is correlated with a kept column
+        kept = set(greedy_keep(corr_matrix, threshold))
+        to_drop = [columns[j] for j in range(len(columns)) if j not in kept]
 
         data_cleaned = data.drop(*to_drop)
 
@@ -44,70 +134,324 @@ def eliminate_low_variance(data, threshold=0.01):
     # Eliminate the low variacne features
     from sklearn.feature_selection import VarianceThreshold
 
+    if isinstance(data, SparkDataFrame):
+        # Population variance of every column in one aggregation, the same statistic as VarianceThreshold
+        columns = spark_numeric_columns(data)
+        variances = data.agg(*[F.var_pop(c).alias(c) for c in columns]).first().asDict()
+        to_drop = [c for c in columns if variances[c] is None or variances[c] <= threshold]
+        return data.drop(*to_drop)
+
     selector = VarianceThreshold(threshold=threshold)
     reduce = selector.fit_transform(data)
     return pd.DataFrame(reduce, columns=data.columns[selector.get_support()])
 
-def apply_pca(data, variance_threshold=0.95, max_component=10):
+# Keep only the first n_components of a fitted PCA, so transform() projects on them
+def truncate_pca(pca, n_components):
+    pca.components_ = pca.components_[:n_components]
+    pca.explained_variance_ = pca.explained_variance_[:n_components]
+    pca.explained_variance_ratio_ = pca.explained_variance_ratio_[:n_components]
+    pca.singular_values_ = pca.singular_values_[:n_components]
+    pca.n_components_ = n_components
+    pca.n_components = n_components
+    return pca
+
+def apply_pca(data, variance_threshold=0.95, max_component=10, method='auto', chunk_size=10000):
+    '''
+    method: 'randomized' fits PCA once with a randomized SVD capped at max_component components,
+            'incremental' fits IncrementalPCA chunk by chunk, without a dense SVD of the whole data,
+            'auto' uses 'incremental' above LARGE_DATA_ROWS rows
+    '''
+    if isinstance(data, SparkDataFrame):
+        return spark_apply_pca(data, variance_threshold, max_component)
+
     pca_info = ""
     # Check the number of variance
     n_features = data.shape[1]
     if n_features < 2:
         pca_info += "Insufficient features after filtering. Returning original data."
-        return data, pca_info
+        return data, pd.DataFrame(columns=data.columns), pca_info, None
+    
+    if method == 'auto':
+        method = 'incremental' if len(data) > LARGE_DATA_ROWS else 'randomized'
     
-    # Using PCA calculate the ratio of cumulative variance
-    pca = PCA()
-    pca.fit(data)
+    # Fit the largest number of components once, the ratio of cumulative variance decides how many of them are kept
+    k = min(max_component, n_features, len(data))
+    if method == 'incremental':
+        pca = IncrementalPCA(n_components=k)
+        for batch in gen_batches(len(data), chunk_size, min_batch_size=k):
+            pca.partial_fit(np.asarray(data.iloc[batch], dtype=float))
+    else:
+        pca = PCA(n_components=k, svd_solver='randomized', random_state=42)
+        pca.fit(np.asarray(data, dtype=float))
     cumulative_variance = pca.explained_variance_ratio_.cumsum()
 
     # Determining the minimum number of components based on variance ratio
     n_components_by_variance = (cumulative_variance < variance_threshold).sum() + 1
-    n_components = min(n_components_by_variance, max_component, n_features)
+    n_components = min(n_components_by_variance, k)
 
     n_components = max(n_components, 2) if n_features > 1 else 1
     pca_info += f"(explained variance threshold: {variance_threshold * 100}%)."
 
-    # Apply PCA
-    pca = PCA(n_components= n_components)
-    reduced_data = pca.fit_transform(data)
+    # Apply PCA with the first components only, chunk by chunk
+    pca = truncate_pca(pca, n_components)
+    reduced_data = np.vstack([pca.transform(chunk) for chunk in iter_chunks(data, chunk_size)])
     reduced_data = pd.DataFrame(reduced_data, columns=[f"PC{i+1}" for i in range(n_components)], index=data.index)
 
     component_importance = pd.DataFrame(pca.components_, columns=data.columns, index=[f"PC{i+1}" for i in range(n_components)])
 
-    return reduced_data, component_importance, pca_info
+    return reduced_data, component_importance, pca_info, pca
+
+def spark_apply_pca(data, variance_threshold=0.95, max_component=10):
+    pca_info = ""
+    columns = spark_numeric_columns(data)
+    n_features = len(columns)
+    if n_features < 2:
+        pca_info += "Insufficient features after filtering. Returning original data."
+        return data.select(ROW_ID, *columns), pd.DataFrame(columns=columns), pca_info, None
+
+    # Fit the largest number of components once, the explained variance decides how many of them are kept
+    k = min(max_component, n_features)
+    features = spark_features(data, "pca_features")
+    pca = sparkPCA(k=k, inputCol="pca_features", outputCol="pca_output").fit(features)
+    cumulative_variance = pca.explainedVariance.toArray().cumsum()
+
+    n_components = (cumulative_variance < variance_threshold).sum() + 1
+    n_components = max(min(n_components, k), 2)
+    pca_info += f"(explained variance threshold: {variance_threshold * 100}%)."
+
+    # Keep the first components as PC columns, the reduced data is reused by every clustering step
+    pc_columns = [f"PC{i+1}" for i in range(n_components)]
+    projected = vector_to_array(F.col("pca_output"))
+    reduced_data = pca.transform(features).select(ROW_ID, *[projected[i].alias(name) for i, name in enumerate(pc_columns)]).cache()
+
+    component_importance = pd.DataFrame(pca.pc.toArray().T[:n_components], columns=columns, index=pc_columns)
+
+    return reduced_data, component_importance, pca_info, pca
+
+# Project very wide data to the Johnson-Lindenstrauss dimension for the number of rows, with a sparse random matrix
+def random_projection(data, eps=RANDOM_PROJECTION_EPS, chunk_size=10000, random_state=42):
+    n_components = int(johnson_lindenstrauss_min_dim(len(data), eps=eps))
+    if n_components >= data.shape[1]:
+        return data, None, ""
+    
+    # The random matrix only depends on the number of columns, so one row is enough to fit it
+    projector = SparseRandomProjection(n_components=n_components, random_state=random_state)
+    projector.fit(np.asarray(data.iloc[:1], dtype=float))
+
+    projected = np.vstack([projector.transform(chunk) for chunk in iter_chunks(data, chunk_size)])
+    projected = pd.DataFrame(projected, columns=[f"RP{i+1}" for i in range(n_components)], index=data.index)
+
+    projection_info = (f"Sparse random projection of {data.shape[1]} columns to {n_components} dimensions before filtering, "
+                       f"with high probability every squared pairwise distance is preserved within a factor of 1 +/- {eps} "
+                       f"(Johnson-Lindenstrauss bound, the distances themselves within about sqrt(1 +/- {eps})). ")
+
+    return projected, projector, projection_info
 
 def filter_data(data, threshold_corr=0.8, threshold_var=0.01, explained_variance=0.95, max_components=10):
+    # Reduce very wide data first, so the following stages do not run on thousands of columns
+    projector = None
+    projection_info = ""
+    if isinstance(data, SparkDataFrame):
+        input_columns = spark_numeric_columns(data)
+    else:
+        data = data.select_dtypes(include='number')
+        input_columns = list(data.columns)
+        if data.shape[1] > WIDE_DATA_COLUMNS:
+            data, projector, projection_info = random_projection(data)
+
     # Filter the highly correlated features
     data = eliminate_high_correlation(data, threshold=threshold_corr)
 
     # Filter the low variacne features
     data = eliminate_low_variance(data, threshold=threshold_var)
 
-    # Apply PCA
-    data, component_importane, pca_info = apply_pca(data, variance_threshold=explained_variance, max_component=max_components)
+    # Apply PCA, the fitted projection is kept to reuse the components without refitting
+    columns = spark_numeric_columns(data) if isinstance(data, SparkDataFrame) else list(data.columns)
+    data, component_importane, pca_info, pca = apply_pca(data, variance_threshold=explained_variance, max_component=max_components)
+    projection = {'input_columns': input_columns, 'random_projection': projector, 'columns': columns,
+                  'pca': pca, 'n_components': len(component_importane.index)}
 
-    return data, component_importane, pca_info
+    return data, component_importane, projection_info + pca_info, projection
 
-# Perform PCA for visualization
-def visualize_pca(data, mode):
+# First two components of the reduced data for visualization, no new PCA is fitted
+# For Spark only a sample of max_points rows is kept, as a (row id, PC1, PC2) DataFrame to join the labels on
+def visualize_pca(data, mode, max_points=10000):
     if mode == 'spark':
-        scaled_data = spark_processing.spark_scaled_df(data)
+        columns = spark_numeric_columns(data)
+        second = F.col(columns[1]) if len(columns) > 1 else F.lit(0.0)
+        fraction = min(1.0, max_points / max(data.count(), 1))
+        return data.select(ROW_ID, F.col(columns[0]).alias("PC1"), second.alias("PC2")).sample(fraction=fraction, seed=42)
     
-    elif mode == 'pandas':
-        scaled_data = pandas_processing.pandas_scale_df(data)
-    pca = PCA(n_components=2)
-    pca_data = pca.fit_transform(scaled_data)
+    pca_data = np.asarray(data, dtype=float)[:, :2]
+    if pca_data.shape[1] < 2:
+        pca_data = np.hstack([pca_data, np.zeros((len(pca_data), 1))])
 
     return pca_data
 
+# Iterate over the rows of a DataFrame or array in chunks
+def iter_chunks(data, chunk_size):
+    for start in range(0, len(data), chunk_size):
+        chunk = data.iloc[start:start + chunk_size] if isinstance(data, pd.DataFrame) else data[start:start + chunk_size]
+        yield np.asarray(chunk, dtype=float)
+
+# Mini-batch k-Means streamed over the rows, with bounded memory
+def fit_minibatch_kmeans(data, n_cluster, init='k-means++', batch_size=4096, n_epochs=3, random_state=42):
+    # Every full batch must hold at least n_cluster rows, otherwise no batch can initialize the centers
+    batch_size = max(batch_size, n_cluster)
+    mini_batch = MiniBatchKMeans(n_clusters=n_cluster, init=init, n_init=1, batch_size=batch_size, random_state=random_state)
+    rng = np.random.RandomState(random_state)
+    
+    for _ in range(n_epochs):
+        # Random batches, a sorted or grouped file would otherwise pull the centers toward its last rows
+        order = rng.permutation(len(data))
+        for start in range(0, len(data), batch_size):
+            index = order[start:start + batch_size]
+            # The first batch must contain at least n_cluster rows to initialize the centers
+            if not hasattr(mini_batch, 'cluster_centers_') and len(index) < n_cluster:
+                continue
+            chunk = data.iloc[index] if isinstance(data, pd.DataFrame) else data[index]
+            mini_batch.partial_fit(np.asarray(chunk, dtype=float))
+
+    # Assign the labels and compute the inertia chunk by chunk
+    labels = []
+    inertia = 0.0
+    for chunk in iter_chunks(data, batch_size):
+        chunk_labels, distances = pairwise_distances_argmin_min(chunk, mini_batch.cluster_centers_)
+        labels.append(chunk_labels)
+        inertia += np.sum(distances ** 2)
+    
+    return np.concatenate(labels), inertia, mini_batch.cluster_centers_
+
+# Fit k-Means once for every number of clusters, shared by the elbow method, the silhouette method and the final labels
+class kmeansSweep:
+    def __init__(self, data, k_min=1, k_max=10, random_state=42, large_data=None, batch_size=4096):
+        '''
+        large_data: use mini-batch k-Means streamed over the rows, None to decide from LARGE_DATA_ROWS
+        '''
+        self.data = data
+        self.k_min = k_min
+        self.k_max = k_max
+        self.random_state = random_state
+        self.large_data = len(data) > LARGE_DATA_ROWS if large_data is None else large_data
+        self.batch_size = batch_size
+        self.inertia = {}
+        self.labels = {}
+        self.centroids = {}
+    
+    def fit(self):
+        rng = np.random.RandomState(self.random_state)
+        centers = None
+
+        if self.large_data:
+            # New centers are seeded from a sample, the full data is only streamed
+            seed_index = rng.choice(len(self.data), min(len(self.data), 10 * self.batch_size), replace=False)
+            seed_data = self.data.iloc[seed_index] if isinstance(self.data, pd.DataFrame) else self.data[seed_index]
+            X = np.asarray(seed_data, dtype=float)
+        else:
+            X = np.asarray(self.data, dtype=float)
+
+        for k in range(self.k_min, self.k_max + 1):
+            # Warm start from the k-1 centroids plus one new center, sampled k-means++ style
+            init = 'k-means++' if centers is None else self.seed_centers(X, centers, rng)
+
+            if self.large_data:
+                labels, inertia, centers = fit_minibatch_kmeans(self.data, k, init=init, batch_size=self.batch_size,
+                                                                random_state=self.random_state)
+            else:
+                if centers is None:
+                    kmeans = KMeans(n_clusters=k, random_state=self.random_state, n_init='auto')
+                else:
+                    kmeans = KMeans(n_clusters=k, init=init, n_init=1, random_state=self.random_state)
+                
+                labels = kmeans.fit_predict(X)
+                inertia = kmeans.inertia_
+                centers = kmeans.cluster_centers_
+
+            self.inertia[k] = inertia
+            self.labels[k] = labels
+            self.centroids[k] = centers
+        
+        return self
+    
+    def seed_centers(self, X, centers, rng):
+        # Pick the new center with probability proportional to the squared distance to the nearest existing center
+        _, distances = pairwise_distances_argmin_min(X, centers)
+        weights = distances ** 2
+        
+        if weights.sum() == 0:
+            new_center = X[rng.randint(len(X))]
+        else:
+            new_center = X[rng.choice(len(X), p=weights / weights.sum())]
+        
+        return np.vstack([centers, new_center])
+    
+    def get_wcss(self):
+        return [self.inertia[k] for k in range(self.k_min, self.k_max + 1)]
+    
+    def get_labels(self, k):
+        return self.labels.get(k)
+
+# Spark counterpart of kmeansSweep, the silhouette of every k is computed by Spark on all rows while fitting
+class sparkKmeansSweep:
+    def __init__(self, data, k_min=1, k_max=10, random_state=42):
+        self.data = data
+        self.k_min = k_min
+        self.k_max = k_max
+        self.random_state = random_state
+        self.features = None
+        self.inertia = {}
+        self.silhouette_scores = {}
+        self.models = {}
+    
+    def fit(self):
+        self.features = spark_features(self.data).cache()
+        evaluator = ClusteringEvaluator(featuresCol="features", predictionCol="prediction", metricName="silhouette")
+
+        for k in range(self.k_min, self.k_max + 1):
+            if k == 1:
+                # Spark k-Means needs at least 2 clusters, the WCSS of one cluster is the total sum of squares
+                columns = spark_numeric_columns(self.data)
+                row = self.data.agg(*[(F.var_pop(c) * F.count(c)).alias(c) for c in columns]).first()
+                self.inertia[k] = float(sum(value or 0.0 for value in row))
+                continue
+
+            model = sparkKMeans(k=k, seed=self.random_state, featuresCol="features").fit(self.features)
+            self.inertia[k] = model.summary.trainingCost
+            self.silhouette_scores[k] = evaluator.evaluate(model.transform(self.features))
+            self.models[k] = model
+        
+        return self
+    
+    def get_wcss(self):
+        return [self.inertia[k] for k in range(self.k_min, self.k_max + 1)]
+    
+    def get_labels(self, k):
+        # Labels stay distributed, as a (row id, prediction) DataFrame
+        model = self.models.get(k)
+        return None if model is None else model.transform(self.features).select(ROW_ID, "prediction")
+    
+    def get_silhouette(self, k):
+        return self.silhouette_scores.get(k)
+
+# Fit a Spark clustering estimator and return the labels as a (row id, prediction) DataFrame
+def spark_cluster_labels(data, estimator):
+    features = spark_features(data)
+    model = estimator.setFeaturesCol("features").fit(features)
+    return model.transform(features).select(ROW_ID, "prediction")
+
+# Add cluster labels to the data as a column, joined on the row id for Spark
+def attach_labels(data, labels, column):
+    if isinstance(data, SparkDataFrame):
+        return data.join(labels.withColumnRenamed("prediction", column), on=ROW_ID, how="left")
+    
+    data[column] = labels
+    return data
+
 # Determine optimal number of clusters using elbow method
-def elbow(data):
-    wcss = []
-    for i in range(1, 11):
-        kmeans = KMeans(n_clusters=i, random_state=42)
-        kmeans.fit(data)
-        wcss.append(kmeans.inertia_)
+def elbow(data, sweep=None):
+    if sweep is None:
+        sweep = kmeansSweep(data).fit()
+    wcss = sweep.get_wcss()
 
     # Find the elbow point
     x1, y1 = 1, wcss[0]
@@ -125,12 +469,15 @@ def elbow(data):
     return elbow_point, wcss
 
 def elbow_plot(elbow_point, wcss, file_name, algorithm, threshold):
-    plt.clf()
-    plt.plot(range(1, 11), wcss, marker='o')
-    plt.axvline(elbow_point, color='b', linestyle='-')
-    plt.xlabel('Number of clusters')
-    plt.ylabel('WCSS')
-    plt.title(f'{file_name}_{threshold}_Elbow Method')
+    figure = new_figure()
+    ax = figure.subplots()
+    ax.plot(range(1, 11), wcss, marker='o')
+    ax.axvline(elbow_point, color='b', linestyle='-')
+    ax.set_xlabel('Number of clusters')
+    ax.set_ylabel('WCSS')
+    ax.set_title(f'{file_name}_{threshold}_Elbow Method')
+
+    return figure
 
 # Algorithm for choosing the number of clusters. 
 def choose_cluster(elbow, silhouette):
@@ -159,63 +506,335 @@ def choose_cluster(elbow, silhouette):
     return chosen_cluster, cluster_info
 
 # Perform k-Means clustering algorithm
-def kmeans(data, n_cluster):
+def kmeans(data, n_cluster, sweep=None):
+    # Reuse the labels of the sweep if it already fitted this number of clusters
+    if sweep is not None and sweep.get_labels(n_cluster) is not None:
+        return sweep.get_labels(n_cluster)
+
+    if isinstance(data, SparkDataFrame):
+        return spark_cluster_labels(data, sparkKMeans(k=n_cluster, seed=42))
+
+    if len(data) > LARGE_DATA_ROWS:
+        labels, _, _ = fit_minibatch_kmeans(data, n_cluster)
+        return labels
+
     kmean = KMeans(n_clusters = n_cluster, random_state=42, n_init='auto')
     labels = kmean.fit_predict(data)
 
     return labels
 
 # Perform Hierarchical clustering, Agglomerative (aka bottom-up method) algorithm
-def agglomerative(data, n_cluster):
-    agg_clustering = AgglomerativeClustering(n_clusters = n_cluster).fit(data)
-    labels = agg_clustering.labels_
+def agglomerative(data, n_cluster, representatives='sample', n_representatives=AGGLOMERATIVE_MAX_ROWS, connectivity_neighbors=None, random_state=42):
+    '''
+    Above AGGLOMERATIVE_MAX_ROWS rows the hierarchy is built on n_representatives representatives, either a random
+    sample of the rows ('sample') or mini-batch k-Means micro-cluster centers ('micro'), and every row gets the
+    cluster of its nearest representative (or of its micro-cluster).
+    connectivity_neighbors: if set, restrict merges to a sparse k-nearest-neighbor connectivity graph
+    For Spark the hierarchy is built top-down by bisecting k-Means, which keeps the data distributed.
+    '''
+    if isinstance(data, SparkDataFrame):
+        return spark_cluster_labels(data, BisectingKMeans(k=n_cluster, seed=random_state))
+
+    def fit_hierarchy(points):
+        connectivity = None
+        if connectivity_neighbors:
+            connectivity = kneighbors_graph(points, n_neighbors=min(connectivity_neighbors, len(points) - 1), include_self=False)
+        
+        return AgglomerativeClustering(n_clusters = n_cluster, connectivity=connectivity).fit(points).labels_
 
-    return labels
+    if len(data) <= AGGLOMERATIVE_MAX_ROWS:
+        return fit_hierarchy(np.asarray(data, dtype=float))
+
+    if representatives == 'micro':
+        micro_labels, _, micro_centers = fit_minibatch_kmeans(data, min(n_representatives, len(data)), random_state=random_state)
+        center_labels = fit_hierarchy(micro_centers)
+        return center_labels[micro_labels]
+    
+    rng = np.random.RandomState(random_state)
+    sample_index = rng.choice(len(data), min(n_representatives, len(data)), replace=False)
+    sample = np.asarray(data.iloc[sample_index] if isinstance(data, pd.DataFrame) else data[sample_index], dtype=float)
+    sample_labels = fit_hierarchy(sample)
+
+    # Assign every row to the cluster of its nearest representative, chunk by chunk
+    nearest = NearestNeighbors(n_neighbors=1).fit(sample)
+    labels = []
+    for chunk in iter_chunks(data, 10000):
+        _, index = nearest.kneighbors(chunk)
+        labels.append(sample_labels[index[:, 0]])
+
+    return np.concatenate(labels)
+
+# Estimate the DBSCAN radius from the knee of the sorted k-nearest-neighbor distances
+def estimate_eps(data, min_samples, sample_size=10000, random_state=42):
+    X = np.asarray(data, dtype=float)
+    neighbors = NearestNeighbors(n_neighbors=min_samples, algorithm='kd_tree').fit(X)
+
+    # The k-distance curve is estimated on a sample of query points
+    rng = np.random.RandomState(random_state)
+    query = X[rng.choice(len(X), min(sample_size, len(X)), replace=False)]
+    distances, _ = neighbors.kneighbors(query)
+    k_distances = np.sort(distances[:, -1])
+
+    # Knee point: farthest point from the line between the first and last k-distances
+    x = np.arange(len(k_distances))
+    x1, y1, x2, y2 = 0, k_distances[0], len(k_distances) - 1, k_distances[-1]
+    numerator = np.abs((y2 - y1) * x - (x2 - x1) * k_distances + x2 * y1 - y2 * x1)
+    denominator = max(((y2 - y1) ** 2 + (x2 - x1) ** 2) ** 0.5, 1e-12)
+    eps = k_distances[np.argmax(numerator / denominator)]
+
+    return max(eps, 1e-6)
+
+# Perform density-based clustering (DBSCAN) on a KD-tree neighbor index, it finds the number of clusters itself
+def density_based(data, eps=None, min_samples=None):
+    if isinstance(data, SparkDataFrame):
+        return spark_density_based(data, eps, min_samples)
+
+    X = np.asarray(data, dtype=float)
+    
+    if min_samples is None:
+        min_samples = max(5, 2 * X.shape[1])
+    min_samples = min(min_samples, len(X))
+
+    if eps is None:
+        eps = estimate_eps(X, min_samples)
+
+    labels = DBSCAN(eps=eps, min_samples=min_samples, algorithm='kd_tree').fit_predict(X)
+
+    n_clusters = len(set(labels) - {-1})
+    n_noise = int(np.sum(labels == -1))
+    density_info = (f"DBSCAN found {n_clusters} clusters and {n_noise} noise points (label -1) "
+                    f"with eps = {eps:.4f} and min_samples = {min_samples}.")
+
+    return labels, density_info
+
+# DBSCAN for Spark: fit on a sample collected to the driver, then every row joins the cluster of its nearest core sample
+# within eps, as DBSCAN does for border points, or becomes noise
+def spark_density_based(data, eps=None, min_samples=None, sample_size=LARGE_DATA_ROWS, random_state=42):
+    columns = spark_numeric_columns(data)
+    fraction = min(1.0, sample_size / max(data.count(), 1))
+    X = np.asarray(data.select(*columns).sample(fraction=fraction, seed=random_state).toPandas(), dtype=float)
+
+    if min_samples is None:
+        min_samples = max(5, 2 * X.shape[1])
+    min_samples = min(min_samples, len(X))
+
+    if eps is None:
+        eps = estimate_eps(X, min_samples)
+
+    dbscan = DBSCAN(eps=eps, min_samples=min_samples, algorithm='kd_tree').fit(X)
+    core_points = X[dbscan.core_sample_indices_]
+    core_labels = dbscan.labels_[dbscan.core_sample_indices_]
+
+    def assign(batches):
+        nearest = NearestNeighbors(n_neighbors=1).fit(core_points) if len(core_points) else None
+        for batch in batches:
+            labels = np.full(len(batch), -1)
+            if nearest is not None:
+                distances, index = nearest.kneighbors(batch[columns].to_numpy(dtype=float))
+                within = distances[:, 0] <= eps
+                labels[within] = core_labels[index[within, 0]]
+            yield pd.DataFrame({ROW_ID: batch[ROW_ID], "prediction": labels})
+
+    labels = data.select(ROW_ID, *columns).mapInPandas(assign, schema=f"{ROW_ID} long, prediction int").cache()
+
+    counts = {row["prediction"]: row["count"] for row in labels.groupBy("prediction").count().collect()}
+    n_clusters = len(set(counts) - {-1})
+    n_noise = counts.get(-1, 0)
+    density_info = (f"DBSCAN found {n_clusters} clusters and {n_noise} noise points (label -1) "
+                    f"with eps = {eps:.4f} and min_samples = {min_samples}, fitted on a sample of {len(X)} rows.")
+
+    return labels, density_info
 
 # Choose which clustering algorithm will be run, depend on the user's choice
-def choose_algo(data, n_cluster, algorithm):
+def choose_algo(data, n_cluster, algorithm, sweep=None, representatives='sample', connectivity_neighbors=None):
     if algorithm == 'k-Means':
-        return kmeans(data, n_cluster)
+        return kmeans(data, n_cluster, sweep=sweep)
     
     elif algorithm == 'Agglomerative':
-        return agglomerative(data, n_cluster)
+        return agglomerative(data, n_cluster, representatives=representatives, connectivity_neighbors=connectivity_neighbors)
+    
+    elif algorithm == 'DBSCAN':
+        labels, _ = density_based(data)
+        return labels
+    
+    else:
+        return kmeans(data, n_cluster, sweep=sweep), agglomerative(data, n_cluster, representatives=representatives, connectivity_neighbors=connectivity_neighbors)
+
+# Generate the cluster plot of the algorithm
+def plot_cluster(pca_df, file_name, algorithm, threshold, render='auto', max_points=PLOT_MAX_POINTS):
+    '''
+    render: 'scatter' draws every point,
+            'sample' draws a stratified sample of max_points points, proportional to the size of every cluster,
+            'density' draws a hexbin density of every point with the cluster centers,
+            'auto' uses 'sample' above max_points points
+    The plotting time and the image size then stay constant as the data grows.
+    '''
+    column = f'{algorithm} Cluster'
+    if column not in pca_df.columns:
+        return None
+    
+    n_points = len(pca_df)
+    if render == 'auto':
+        render = 'sample' if n_points > max_points else 'scatter'
+    
+    title = f'{file_name} {threshold} {algorithm} Cluster'
+    figure = new_figure()
+    ax = figure.subplots()
+
+    if render == 'density':
+        ax.hexbin(pca_df[0], pca_df[1], gridsize=60, bins='log', cmap='Greys', mincnt=1)
+        centers = pca_df.groupby(column)[[0, 1]].mean()
+        for label, center in centers.iterrows():
+            ax.annotate(str(label), (center[0], center[1]), color='red', fontweight='bold', ha='center', va='center')
+        title += f' (density of {n_points} points)'
     
     else:
-        return kmeans(data, n_cluster), agglomerative(data, n_cluster)
+        if render == 'sample' and n_points > max_points:
+            pca_df = pca_df.iloc[stratified_sample_index(pca_df[column], max_points)]
+            title += f' (sample of {len(pca_df)} of {n_points} points)'
+        sns.scatterplot(x=pca_df[0], y=pca_df[1], hue=column, data=pca_df, ax=ax)
+    
+    ax.set_title(title)
+
+    return figure
 
-# Generate the cluster plots, depending on the user's choice
-def plot_cluster(pca_df, file_name, algorithm, threshold):
+# Silhouette value of every sample, computed from per-cluster distance sums in blocks of rows sized to a memory budget
+def silhouette_blockwise(data, labels, block_bytes=SILHOUETTE_BLOCK_BYTES):
+    X = np.asarray(data, dtype=float)
+    _, codes = np.unique(labels, return_inverse=True)
+    counts = np.bincount(codes)
+    one_hot = np.eye(len(counts))[codes]
+
+    # Every row of a block holds n float64 distances
+    block_size = max(1, block_bytes // (8 * len(X)))
+
+    silhouette_values = np.zeros(len(X))
+    for start in range(0, len(X), block_size):
+        end = min(start + block_size, len(X))
+        own = codes[start:end]
+        rows = np.arange(end - start)
+
+        # Only a (block_size x n) distance block, at most block_bytes, is kept in memory
+        cluster_sums = pairwise_distances(X[start:end], X) @ one_hot
+
+        a = cluster_sums[rows, own] / np.maximum(counts[own] - 1, 1)
+        mean_distances = cluster_sums / counts
+        mean_distances[rows, own] = np.inf
+        b = mean_distances.min(axis=1)
+
+        values = (b - a) / np.maximum(np.maximum(a, b), 1e-12)
+        values[counts[own] == 1] = 0        # Silhouette of a singleton cluster is 0
+        silhouette_values[start:end] = values
     
-    # If user choose only Agglomerative clustering algorithm, then plot agglomerative cluster
-    if 'Agglomerative Cluster' in pca_df.columns:
-        axs = plt.subplots()
-        axs = sns.scatterplot(x=pca_df[0], y=pca_df[1], hue='Agglomerative Cluster', data=pca_df)
-        plt.title(f'{file_name} {threshold} {algorithm} Cluster')
-        #plt.savefig(f'./static/_img/{file_name}_{threshold}_Agglomerative_Cluster.png')
+    return silhouette_values
+
+# Stratified sample of the rows, proportional to the size of every cluster (at least 2 rows per cluster)
+def stratified_sample_index(labels, sample_size, random_state=42):
+    rng = np.random.RandomState(random_state)
+    labels = np.asarray(labels)
+    fraction = min(1.0, sample_size / len(labels))
+
+    index = []
+    for label in np.unique(labels):
+        members = np.flatnonzero(labels == label)
+        n_members = min(len(members), max(2, int(round(len(members) * fraction))))
+        index.append(rng.choice(members, n_members, replace=False))
     
-    # If user choose only k-Means clustering algorithm, then plot k-Means cluster
-    if 'k-Means Cluster' in pca_df.columns:
-        axs = plt.subplots()
-        axs = sns.scatterplot(x=pca_df[0], y=pca_df[1], hue='k-Means Cluster', data=pca_df)
-        plt.title(f'{file_name} {threshold} {algorithm} Cluster')
-        #plt.savefig(f'./static/_img/{file_name}_{threshold}_k-Means_Cluster.png')
+    return np.sort(np.concatenate(index))
+
+# Mean silhouette and the half width of its 95% confidence interval, exact or on a stratified sample
+def silhouette_summary(data, labels, method='exact', sample_size=10000, block_bytes=SILHOUETTE_BLOCK_BYTES, random_state=42):
+    X = np.asarray(data, dtype=float)
+    labels = np.asarray(labels)
+
+    if method == 'sample':
+        index = stratified_sample_index(labels, sample_size, random_state)
+        values = silhouette_blockwise(X[index], labels[index], block_bytes)
+        return values.mean(), 1.96 * values.std(ddof=1) / np.sqrt(len(values))
+    
+    values = silhouette_blockwise(X, labels, block_bytes)
+    return values.mean(), 0.0
+
+# Silhouette of the clustered rows of a Spark DataFrame, noise points (label -1) are left out
+def spark_silhouette(data, labels):
+    clustered = spark_features(data).join(labels.filter(F.col("prediction") != -1), on=ROW_ID)
+    if clustered.select("prediction").distinct().count() < 2:
+        return 0.0
+    
+    return ClusteringEvaluator(featuresCol="features", predictionCol="prediction", metricName="silhouette").evaluate(clustered)
+
+# Collect a sample of the first two components with the cluster labels, for the cluster plots
+def spark_plot_sample(data, labeled, label_columns, max_points=10000):
+    sample = visualize_pca(data, 'spark', max_points).join(labeled.select(ROW_ID, *label_columns), on=ROW_ID).toPandas()
+
+    pca_df = pd.DataFrame({0: sample["PC1"], 1: sample["PC2"]})
+    for column in label_columns:
+        pca_df[column] = sample[column]
+    
+    return pca_df
 
 # Determine optimal number of clusters using silhouette method
 class silhouetteAnalyze:
-    def __init__(self, data):
+    def __init__(self, data, sweep=None, method='auto', sample_size=10000, block_bytes=SILHOUETTE_BLOCK_BYTES, random_state=42):
+        '''
+        method: 'exact' computes the silhouette on every row in memory-bounded blocks,
+                'sample' computes it on a stratified sample of sample_size rows with a 95% confidence interval,
+                'auto' uses 'sample' when there are more than sample_size rows
+        '''
         self.data = data
+        self.sweep = sweep
+        self.method = method
+        self.sample_size = sample_size
+        self.block_bytes = block_bytes
+        self.random_state = random_state
         self.silhouette_scores = None
+        self.confidence = None
+        self.method_used = None
         self.optimal_clusters = None
     
     def analyze(self):
+        if isinstance(self.data, SparkDataFrame):
+            # Spark already computed the silhouette on all rows while fitting the sweep
+            if self.sweep is None:
+                self.sweep = sparkKmeansSweep(self.data).fit()
+            self.method_used = 'spark'
+            self.silhouette_scores = [self.sweep.get_silhouette(i) for i in range(2, 11)]
+            self.confidence = [0.0] * len(self.silhouette_scores)
+            return
+
+        if self.sweep is None:
+            self.sweep = kmeansSweep(self.data).fit()
+
+        X = np.asarray(self.data, dtype=float)
+        self.method_used = self.method
+        if self.method == 'auto':
+            self.method_used = 'sample' if len(X) > self.sample_size else 'exact'
+
         silhouette_scores = []
+        confidence = []
         for i in range(2, 11):
-            kmeans = KMeans(n_clusters=i, random_state=42)
-            cluster_labels = kmeans.fit_predict(self.data)
-            silhouette_avg = silhouette_score(self.data, cluster_labels)
-            silhouette_scores.append(silhouette_avg)
+            score, half_width = silhouette_summary(X, self.sweep.get_labels(i), self.method_used,
+                                                   self.sample_size, self.block_bytes, self.random_state)
+            silhouette_scores.append(score)
+            confidence.append(half_width)
         
         self.silhouette_scores = silhouette_scores
+        self.confidence = confidence
+    
+    def get_method_info(self, n_cluster=None):
+        if self.method_used is None:
+            return ""
+        
+        if self.method_used == 'spark':
+            return "Silhouette scores computed by Spark on all rows, with squared Euclidean distances."
+        
+        if self.method_used == 'exact':
+            return f"Silhouette scores computed exactly on all {len(self.data)} rows."
+        
+        info = f"Silhouette scores estimated on a stratified sample of up to {self.sample_size} of {len(self.data)} rows"
+        if n_cluster is not None:
+            info += f" (95% confidence interval for {n_cluster} clusters: +/- {self.confidence[n_cluster - 2]:.4f})"
+        return info + "."
     
     def get_optimal_clusters(self):
         if self.silhouette_scores is None:
@@ -236,11 +855,132 @@ class silhouetteAnalyze:
     def plot(self, file_name, algorithm, threshold):
         if self.silhouette_scores is None:
             print("Call analyze() method first to compute silhouette scores.")
-            return
+            return None
         
-        plt.clf()
-        plt.plot(range(2, 11), self.silhouette_scores, marker='o')
-        plt.axvline(self.optimal_clusters, color='b', linestyle='-')
-        plt.xlabel('Number of clusters')
-        plt.ylabel('Silhouette Score')
-        plt.title(f'{file_name}_{threshold}_Silhouette Method')
+        figure = new_figure()
+        ax = figure.subplots()
+        ax.plot(range(2, 11), self.silhouette_scores, marker='o')
+        ax.axvline(self.optimal_clusters, color='b', linestyle='-')
+        ax.set_xlabel('Number of clusters')
+        ax.set_ylabel('Silhouette Score')
+        ax.set_title(f'{file_name}_{threshold}_Silhouette Method')
+
+        return figure
+
+# Mean of the reduced rows of every cluster, noise points (label -1) are left out
+def cluster_centroids(data, labels):
+    if isinstance(data, SparkDataFrame):
+        columns = spark_numeric_columns(data)
+        rows = (data.join(labels.filter(F.col("prediction") != -1), on=ROW_ID)
+                .groupBy("prediction").agg(*[F.avg(c).alias(c) for c in columns]).orderBy("prediction").collect())
+        centroids = np.array([[row[c] for c in columns] for row in rows], dtype=float).reshape(len(rows), len(columns))
+        return np.array([row["prediction"] for row in rows], dtype=int), centroids
+    
+    labels = np.asarray(labels)
+    clustered = labels != -1
+    centroids = pd.DataFrame(np.asarray(data, dtype=float)[clustered]).groupby(labels[clustered]).mean()
+    return centroids.index.to_numpy(dtype=int), centroids.to_numpy(dtype=float)
+
+# Collect the fitted pipeline as NumPy arrays, so new rows can be assigned without refitting
+def build_cluster_model(pre_df, projection, reduced, clusters, gender_mapping):
+    '''
+    The model holds the imputation means of the input columns, the random projection, the columns kept by the
+    filters, the PCA mean and components, and the centroids of every algorithm in the reduced space.
+    New rows are assigned to the cluster of the nearest centroid, which is exact for k-Means and an approximation
+    for Agglomerative and DBSCAN.
+
+    Parameters
+    - pre_df: Preprocessed data passed to filter_data
+    - projection (dict): Projection returned by filter_data
+    - reduced: Reduced data returned by filter_data
+    - clusters (dict): Labels of the reduced rows for every algorithm
+    - gender_mapping (dict): Encoding of the gender column
+    '''
+    input_columns = projection['input_columns']
+    if isinstance(pre_df, SparkDataFrame):
+        means = pre_df.agg(*[F.avg(c).alias(c) for c in input_columns]).first()
+        fill_values = np.array([0.0 if means[c] is None else means[c] for c in input_columns], dtype=float)
+    else:
+        fill_values = pre_df[input_columns].mean().fillna(0).to_numpy(dtype=float)
+
+    model = {'input_columns': np.array(input_columns, dtype=str), 'fill_values': fill_values}
+
+    space = input_columns
+    if projection['random_projection'] is not None:
+        components = projection['random_projection'].components_
+        model['random_projection'] = components.toarray() if hasattr(components, 'toarray') else np.asarray(components)
+        space = [f"RP{i+1}" for i in range(model['random_projection'].shape[0])]
+    model['kept_index'] = np.array([space.index(c) for c in projection['columns']], dtype=int)
+
+    pca = projection['pca']
+    n_kept = len(projection['columns'])
+    if pca is None:
+        model['pca_mean'] = np.zeros(n_kept)
+        model['pca_components'] = np.eye(n_kept)
+    elif hasattr(pca, 'components_'):
+        model['pca_mean'] = pca.mean_
+        model['pca_components'] = pca.components_
+    else:
+        # Spark PCA projects without centering
+        model['pca_mean'] = np.zeros(n_kept)
+        model['pca_components'] = pca.pc.toArray().T[:projection['n_components']]
+
+    model['algorithms'] = np.array(list(clusters), dtype=str)
+    for algorithm, labels in clusters.items():
+        model[f'labels_{algorithm}'], model[f'centroids_{algorithm}'] = cluster_centroids(reduced, labels)
+
+    gender_column = next((c for c in ('sex', 'gender') if c in input_columns), '')
+    model['gender_column'] = np.array(gender_column)
+    model['gender_labels'] = np.array(sorted(gender_mapping, key=gender_mapping.get), dtype=str)
+
+    return model
+
+def save_cluster_model(model):
+    buffer = io.BytesIO()
+    np.savez_compressed(buffer, **model)
+    buffer.seek(0)
+    return buffer
+
+def load_cluster_model(buffer):
+    with np.load(buffer, allow_pickle=False) as archive:
+        return {key: archive[key] for key in archive.files}
+
+# Reduced coordinates of raw rows, with the preprocessing and projection of the cluster model
+def transform_rows(data, model):
+    frame = data.reindex(columns=list(model['input_columns']))
+
+    gender_column = str(model['gender_column'])
+    if gender_column and gender_column in data.columns:
+        encoding = {label: index for index, label in enumerate(model['gender_labels'])}
+        frame[gender_column] = data[gender_column].apply(pandas_processing.pandas_standardize_gender).map(encoding)
+
+    X = frame.apply(pd.to_numeric, errors='coerce').to_numpy(dtype=float)
+    X = np.where(np.isnan(X), model['fill_values'], X)
+
+    if 'random_projection' in model:
+        X = X @ model['random_projection'].T
+    
+    return (X[:, model['kept_index']] - model['pca_mean']) @ model['pca_components'].T
+
+# Assign raw rows to the clusters of a cluster model, chunk by chunk (partition by partition for Spark)
+def assign_clusters(data, model, chunk_size=10000):
+    algorithms = list(model['algorithms'])
+    label_columns = [f"{algorithm} Cluster" for algorithm in algorithms]
+
+    def assign_chunk(chunk):
+        reduced = transform_rows(chunk, model)
+        chunk = chunk.copy()
+        for algorithm, column in zip(algorithms, label_columns):
+            centroids = model[f'centroids_{algorithm}']
+            if len(centroids) == 0:
+                chunk[column] = -1
+                continue
+            index, _ = pairwise_distances_argmin_min(reduced, centroids)
+            chunk[column] = model[f'labels_{algorithm}'][index]
+        return chunk
+
+    if isinstance(data, SparkDataFrame):
+        schema = StructType(data.schema.fields + [StructField(column, LongType()) for column in label_columns])
+        return data.mapInPandas(lambda batches: (assign_chunk(batch) for batch in batches), schema=schema)
+    
+    return pd.concat([assign_chunk(data.iloc[start:start + chunk_size]) for start in range(0, len(data), chunk_size)])
@@ -1,6 +1,12 @@
 from models import common
-from .clustering import filter_data, elbow, elbow_plot, silhouetteAnalyze, choose_cluster, choose_algo, visualize_pca, plot_cluster, pd, plt
+from .clustering import filter_data, kmeansSweep, sparkKmeansSweep, elbow, elbow_plot, silhouetteAnalyze, silhouette_summary, choose_cluster, choose_algo, density_based, visualize_pca, plot_cluster, pd, np
+from .clustering import attach_labels, spark_silhouette, spark_plot_sample
+from .clustering import build_cluster_model, save_cluster_model, load_cluster_model, assign_clusters
+from .common import ROW_ID
+from pyspark.sql import functions as F
+from botocore.exceptions import ClientError
 from pathlib import Path
+import csv
 from reportlab.lib import colors
 from reportlab.lib.pagesizes import letter, landscape
 from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Image, HRFlowable, Table, TableStyle
@@ -9,12 +15,13 @@ import io
 from reportlab.lib.utils import ImageReader
 
 
-def run_cluster(file_key, threshold, algorithm, plot):
+def run_cluster(file_key, threshold, algorithm, plot, representatives='sample', connectivity_neighbors=None):
 
     # Call the file and save it to a variable, df
     df, mode = common.load_file(file_key)
     if mode == 'spark':
-        df = df.na.drop(how='all')
+        # Every row gets an id so the labels computed on the reduced data can be joined back
+        df = df.na.drop(how='all').withColumn(ROW_ID, F.monotonically_increasing_id()).cache()
     else:
         df = df.dropna(how='all')
     file_name = Path(file_key).stem
@@ -34,58 +41,91 @@ def run_cluster(file_key, threshold, algorithm, plot):
     label = list(gender_mapping.values())
 
     # Reduce columns with the most relevant columns
-    filtered_df, variables, pca_info = filter_data(pre_df, threshold_corr=0.85, threshold_var=0.02, explained_variance=0.95, max_components=10)
+    filtered_df, variables, pca_info, projection = filter_data(pre_df, threshold_corr=0.85, threshold_var=0.02, explained_variance=0.95, max_components=10)
 
     useful_variable = f"Use {variables.columns} to cluster. {pca_info}"
 
-    # Elbow method to determine the number of clusters
-    elbow_cluster, wcss = elbow(filtered_df)
+    if algorithm == 'DBSCAN':
+        # Density-based clustering finds the number of clusters itself, no k-Means sweep is needed
+        cluster, cluster_info = density_based(filtered_df)
+    
+    else:
+        # Fit k-Means once for k = 1..10, shared by both methods and the final k-Means labels
+        if mode == 'spark':
+            sweep = sparkKmeansSweep(filtered_df, k_min=1, k_max=10).fit()
+        else:
+            sweep = kmeansSweep(filtered_df, k_min=1, k_max=10).fit()
+
+        # Elbow method to determine the number of clusters
+        elbow_cluster, wcss = elbow(filtered_df, sweep=sweep)
 
 
-    # Silhouette method to determine the number of clusters
-    silhouette = silhouetteAnalyze(filtered_df)
-    silhouette.analyze()
-    silhou_cluster = silhouette.get_optimal_clusters()
+        # Silhouette method to determine the number of clusters
+        silhouette = silhouetteAnalyze(filtered_df, sweep=sweep)
+        silhouette.analyze()
+        silhou_cluster = silhouette.get_optimal_clusters()
 
-    # silhouette.plot(file_name, algorithm, threshold)
+        # silhouette.plot(file_name, algorithm, threshold)
 
-    n_cluster, cluster_info = choose_cluster(elbow_cluster, silhou_cluster)
-    cluster = choose_algo(filtered_df, n_cluster, algorithm)
+        n_cluster, cluster_info = choose_cluster(elbow_cluster, silhou_cluster)
+        cluster = choose_algo(filtered_df, n_cluster, algorithm, sweep=sweep,
+                              representatives=representatives, connectivity_neighbors=connectivity_neighbors)
     
-    if algorithm == 'both':
+    if algorithm == 'DBSCAN':
+        clusters = {'DBSCAN': cluster}
+
+    elif algorithm == 'both':
         kmeans_label, agglom_label = cluster
-        df['k-Means Cluster'] = kmeans_label
-        df['Agglomerative Cluster'] = agglom_label
+        clusters = {'k-Means': kmeans_label, 'Agglomerative': agglom_label}
 
     elif algorithm == 'k-Means':
-        kmeans_label = cluster
-        df['k-Means Cluster'] = kmeans_label
+        clusters = {'k-Means': cluster}
         
     elif algorithm == 'Agglomerative':
-        agglom_label = cluster
-        df['Agglomerative Cluster'] = agglom_label
+        clusters = {'Agglomerative': cluster}
+    
+    for name, labels in clusters.items():
+        df = attach_labels(df, labels, f'{name} Cluster')
 
-    image_buffers = []
+    # The plots are collected first and rendered one after the other: Agg and seaborn drawing hold the GIL,
+    # so threads would not render them faster
+    plot_tasks = []
 
     def add_plot_to_pdf(plot_func, *args):
+        plot_tasks.append((plot_func, args))
+
+    def render_plot(task):
+        plot_func, args = task
+        figure = plot_func(*args)
+        if figure is None:
+            return None
         img_buffer = io.BytesIO()
-        plot_func(*args)
-        plt.savefig(img_buffer, format='png')
-        plt.close()
+        figure.savefig(img_buffer, format='png')
         img_buffer.seek(0)
-        image_buffers.append(img_buffer)
-    add_plot_to_pdf(elbow_plot, elbow_cluster, wcss, file_name, algorithm, threshold)
-    add_plot_to_pdf(silhouette.plot, file_name, algorithm, threshold)
+        return img_buffer
+
+    if algorithm != 'DBSCAN':
+        add_plot_to_pdf(elbow_plot, elbow_cluster, wcss, file_name, algorithm, threshold)
+        add_plot_to_pdf(silhouette.plot, file_name, algorithm, threshold)
 
     if plot == 'yes':
-        pca = visualize_pca(filtered_df, mode)
-        
-        pca_df = pd.DataFrame(pca)
-        if 'k-Means Cluster' in df.columns:
-            pca_df['k-Means Cluster'] = df['k-Means Cluster']
+        if mode == 'spark':
+            # Only a sample of the first two components is collected for the plots
+            label_columns = [c for c in ['k-Means Cluster', 'Agglomerative Cluster', 'DBSCAN Cluster'] if c in df.columns]
+            pca_df = spark_plot_sample(filtered_df, df, label_columns)
         
-        if 'Agglomerative Cluster' in df.columns:
-            pca_df['Agglomerative Cluster'] = df['Agglomerative Cluster']
+        else:
+            pca = visualize_pca(filtered_df, mode)
+            
+            pca_df = pd.DataFrame(pca)
+            if 'k-Means Cluster' in df.columns:
+                pca_df['k-Means Cluster'] = df['k-Means Cluster'].to_numpy()
+            
+            if 'Agglomerative Cluster' in df.columns:
+                pca_df['Agglomerative Cluster'] = df['Agglomerative Cluster'].to_numpy()
+            
+            if 'DBSCAN Cluster' in df.columns:
+                pca_df['DBSCAN Cluster'] = df['DBSCAN Cluster'].to_numpy()
         
         if algorithm == 'both':
             add_plot_to_pdf(plot_cluster, pca_df, file_name, "k-Means", threshold)
@@ -94,10 +134,27 @@ def run_cluster(file_key, threshold, algorithm, plot):
             add_plot_to_pdf(plot_cluster, pca_df, file_name, "k-Means", threshold)
         elif algorithm == 'Agglomerative':
             add_plot_to_pdf(plot_cluster, pca_df, file_name, "Agglomerative", threshold)
-
-
-    scores = silhouette.get_silhouette_scores()
-    scores = scores[n_cluster - 2]
+        elif algorithm == 'DBSCAN':
+            add_plot_to_pdf(plot_cluster, pca_df, file_name, "DBSCAN", threshold)
+
+    image_buffers = [img_buffer for img_buffer in map(render_plot, plot_tasks) if img_buffer is not None]
+
+    if algorithm == 'DBSCAN' and mode == 'spark':
+        scores = spark_silhouette(filtered_df, cluster)
+        method_info = "Silhouette score of the clustered points (Spark, squared Euclidean distances)."
+    elif algorithm == 'DBSCAN':
+        # Silhouette of the clustered points, noise points are left out
+        clustered = np.asarray(cluster) != -1
+        method = 'sample' if clustered.sum() > 10000 else 'exact'
+        if len(set(np.asarray(cluster)[clustered])) > 1:
+            scores, half_width = silhouette_summary(filtered_df[clustered], np.asarray(cluster)[clustered], method=method)
+        else:
+            scores, half_width = 0.0, 0.0
+        method_info = f"Silhouette score of the clustered points ({method}" + (f", +/- {half_width:.4f})." if method == 'sample' else ").")
+    else:
+        scores = silhouette.get_silhouette_scores()
+        scores = scores[n_cluster - 2]
+        method_info = silhouette.get_method_info(n_cluster)
     
     if scores >= 0.5:
         score_info = "Since Silhouette Score is greater than or equal to 0.5, it is STRONG evidence of well-defined clusters."
@@ -114,7 +171,7 @@ def run_cluster(file_key, threshold, algorithm, plot):
     elif scores <= -0.5:
         score_info = "Since Silhouette Score is smaller than or eqaul to -0.5, it is Strong evidence of misclassification or poor clustering structure."
     
-    silhouette_info = f"\nSilhouette Score: {scores}"
+    silhouette_info = f"\nSilhouette Score: {scores}. {method_info}"
 
     pca_text = Paragraph(pca_info, styles['Normal'])
     variable_text = Paragraph(useful_variable, styles['Normal'])
@@ -139,8 +196,52 @@ def run_cluster(file_key, threshold, algorithm, plot):
 
     doc.build(content)
 
+    if mode == 'spark':
+        # Keep the labeled rows in their original order
+        df = df.orderBy(ROW_ID).drop(ROW_ID)
+    csv_buffer = write_csv(df, mode)
+
+    # Save the fitted pipeline, to assign new rows to the clusters without refitting
+    model_buffer = save_cluster_model(build_cluster_model(pre_df, projection, filtered_df, clusters, gender_mapping))
+
+    return pdf_buffer, csv_buffer, model_buffer
+
+def write_csv(df, mode):
     csv_buffer = io.BytesIO()
-    df.to_csv(csv_buffer, index=False)
+    if mode == 'spark':
+        # Stream the rows partition by partition, without collecting the whole DataFrame
+        text_buffer = io.TextIOWrapper(csv_buffer, encoding='utf-8', newline='')
+        writer = csv.writer(text_buffer)
+        writer.writerow(df.columns)
+        for row in df.toLocalIterator():
+            writer.writerow(row)
+        text_buffer.flush()
+        text_buffer.detach()
+    else:
+        df.to_csv(csv_buffer, index=False)
     csv_buffer.seek(0)
 
-    return pdf_buffer, csv_buffer
+    return csv_buffer
+
+def run_assign(file_key, model_file):
+    '''
+    Assign the rows of an uploaded file to the clusters of a saved cluster model
+
+    Parameters
+    - file_key (str): Path of the uploaded file with the new rows
+    - model_file (str): Name of the file the cluster model was fitted on
+
+    Returns
+    - BytesIO: CSV of the rows with their cluster labels
+    '''
+    model_key = f"result/{model_file}_cluster_model.npz"
+    try:
+        response = common.s3.get_object(Bucket=common.S3_BUCKET_NAME, Key=model_key)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+            raise FileNotFoundError(f"Cluster model '{model_key}' does not exist in S3 bucket '{common.S3_BUCKET_NAME}'")
+        raise e
+    model = load_cluster_model(io.BytesIO(response['Body'].read()))
+
+    df, mode = common.load_file(file_key)
+    return write_csv(assign_clusters(df, model), mode)
@@ -1,16 +1,21 @@
 import pandas as pd
+from pandas.api.types import union_categoricals
 import numpy as np
 from sklearn.preprocessing import StandardScaler as sklearnStandardScaler, LabelEncoder
 from sklearn.impute import SimpleImputer
 import re
 from dotenv import load_dotenv
 import os
+import threading
 from logger_utils import logger
 import boto3
 from botocore.exceptions import ClientError
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
 from pyspark.sql import SparkSession
-from pyspark.sql.functions import col, lower, udf
-from pyspark.ml.feature import Imputer, StringIndexer, StandardScaler as sparkStandardScaler, VectorAssembler
+from pyspark.sql.functions import col, lower
+from pyspark.ml.feature import Imputer, StringIndexer
 from pyspark.sql.types import DoubleType, FloatType, IntegerType, LongType, StringType
 from pyspark.sql import functions as F
 
@@ -25,57 +30,300 @@ S3_BUCKET_NAME = "ml-platform-service"
 
 s3 = boto3.client('s3')
 
+# Local copies of the uploaded files, keyed by their S3 ETag, shared by every job on the node (pandas only)
+LOCAL_CACHE_DIR = os.environ.get("LOCAL_CACHE_DIR", "/tmp/ml_paas_cache")
+
+# Size of the local cache, the least recently used copies are removed above it
+LOCAL_CACHE_MAX_BYTES = int(os.environ.get("LOCAL_CACHE_MAX_BYTES", 10 * 1024 ** 3))
+
+# Block size used to infer the column types of a CSV file when converting it to Parquet
+PARQUET_INFERENCE_BLOCK_SIZE = 64 * 1024 * 1024
+
+# Rows read at a time by the pandas loader
+PANDAS_CHUNK_SIZE = 100000
+
+# String columns with at most this ratio of unique values are kept as category
+CATEGORY_MAX_UNIQUE_RATIO = 0.5
+
+# Column holding a unique id for every row of a Spark DataFrame, used to join results back to the rows
+ROW_ID = "_row_id"
+
+# Download an S3 object once per node and return the path of its local copy
+def fetch_to_cache(file_path, etag):
+    os.makedirs(LOCAL_CACHE_DIR, exist_ok=True)
+    file_extension = file_path.split('.')[-1]
+    local_path = os.path.join(LOCAL_CACHE_DIR, f"{etag}.{file_extension}")
+
+    if os.path.exists(local_path):
+        # The modification time records the last use, for the eviction
+        os.utime(local_path)
+        logger.info(f"Using the local copy of {file_path}: {local_path}")
+        return local_path
+    
+    # Download to a temporary name and rename, so concurrent jobs never read a partial file
+    temp_path = f"{local_path}.{os.getpid()}.{threading.get_ident()}.part"
+    try:
+        s3.download_file(S3_BUCKET_NAME, file_path, temp_path)
+        os.replace(temp_path, local_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+    evict_cache(keep=local_path)
+    return local_path
+
+# Remove the least recently used local copies until the cache fits in LOCAL_CACHE_MAX_BYTES
+def evict_cache(keep=None):
+    entries = []
+    for entry in os.scandir(LOCAL_CACHE_DIR):
+        # Partial downloads belong to running jobs
+        if entry.is_file() and not entry.name.endswith('.part'):
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= LOCAL_CACHE_MAX_BYTES:
+            break
+        if path == keep:
+            continue
+        try:
+            os.remove(path)
+            total -= size
+            logger.info(f"Evicted {path} from the local cache")
+        except FileNotFoundError:
+            # Already removed by another job
+            total -= size
+
+# S3 object metadata from a HEAD request, None if the object does not exist
+def head_file(file_path):
+    try:
+        return s3.head_object(Bucket=S3_BUCKET_NAME, Key=file_path)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+            return None
+        raise e
+
+# Key of the Parquet copy of an uploaded file
+def parquet_key(file_name):
+    return f"parquet/{file_name}.parquet"
+
+# Metadata of the Parquet copy holding the ETag of the upload it was converted from
+SOURCE_ETAG_METADATA = "source-etag"
+
+# CSV convert options keeping date and time columns as strings, as pandas.read_csv reads them
+def csv_convert_options(schema=None):
+    column_types = {}
+    if schema is not None:
+        column_types = {field.name: pa.string() for field in schema if pa.types.is_temporal(field.type)}
+    
+    return pa_csv.ConvertOptions(column_types=column_types, timestamp_parsers=[])
+
+# Convert an uploaded CSV file to Parquet once, so later jobs read typed columnar data
+def convert_to_parquet(file_name):
+    '''
+    CSV files are streamed block by block into a Parquet writer, with the types inferred on the first block.
+    Date and time columns are kept as strings, as pandas.read_csv and the raw file fallback of load_file read them,
+    so a job gets the same frame whether or not the conversion has finished.
+    XLSX and JSON files are not converted: pandas would read them whole in the web worker, and the layout
+    pandas.read_json expects differs from the one spark.read.json reads. Jobs read them from the raw file.
+    The Parquet copy records the ETag of its upload, and is removed if the conversion fails, so a copy of an
+    earlier upload with the same name is never read.
+
+    Parameters
+    - file_name (str): Name of the file in the uploaded/ folder
+
+    Returns
+    - str: Key of the Parquet file in the S3 bucket, None if the file is not converted or the conversion failed
+    '''
+    file_path = f"uploaded/{file_name}"
+    file_extension = file_name.split('.')[-1]
+
+    if file_extension != 'csv':
+        logger.info(f"File {file_name} is read from the raw file, only CSV files are converted to Parquet")
+        return None
+
+    try:
+        response = head_file(file_path)
+        if response is None:
+            raise FileNotFoundError(f"File '{file_name}' does not exist in S3 bucket '{S3_BUCKET_NAME}'")
+        
+        etag = response['ETag'].strip('"')
+        local_path = fetch_to_cache(file_path, etag)
+        parquet_path = f"{local_path}.parquet"
+
+        read_options = pa_csv.ReadOptions(block_size=PARQUET_INFERENCE_BLOCK_SIZE)
+        try:
+            schema = pa_csv.open_csv(local_path, read_options=read_options, convert_options=csv_convert_options()).schema
+            reader = pa_csv.open_csv(local_path, read_options=read_options, convert_options=csv_convert_options(schema))
+            with pq.ParquetWriter(parquet_path, reader.schema) as writer:
+                for batch in reader:
+                    writer.write_batch(batch)
+        except pa.ArrowInvalid as e:
+            # A later block does not match the types of the first one, infer them on the whole file instead
+            logger.info(f"Reading {file_name} in one block: {e}")
+            schema = pa_csv.read_csv(local_path, convert_options=csv_convert_options()).schema
+            pq.write_table(pa_csv.read_csv(local_path, convert_options=csv_convert_options(schema)), parquet_path)
+        
+        s3.upload_file(parquet_path, S3_BUCKET_NAME, parquet_key(file_name),
+                       ExtraArgs={'Metadata': {SOURCE_ETAG_METADATA: etag}})
+        os.remove(parquet_path)
+        logger.info(f"File {file_name} converted to Parquet: {parquet_key(file_name)}")
+        return parquet_key(file_name)
+    
+    except Exception as e:
+        logger.error(f"Error converting {file_name} to Parquet: {e}")
+        try:
+            s3.delete_object(Bucket=S3_BUCKET_NAME, Key=parquet_key(file_name))
+        except ClientError as delete_error:
+            logger.error(f"Error removing the Parquet copy of {file_name}: {delete_error}")
+        return None
+
+# Convert an upload to Parquet in a background thread, off the request that uploaded it
+def convert_to_parquet_async(file_name):
+    thread = threading.Thread(target=convert_to_parquet, args=(file_name,), daemon=True)
+    thread.start()
+    return thread
+
+# Downcast the columns of a DataFrame to the smallest safe type: float32, int8/16/32 and category for strings
+def downcast_frame(data):
+    for column in data.columns:
+        series = data[column]
+        if pd.api.types.is_bool_dtype(series):
+            continue
+        if pd.api.types.is_float_dtype(series):
+            # float32 only when every value survives the round trip unchanged
+            downcast = series.astype(np.float32)
+            if np.array_equal(downcast.to_numpy(dtype=np.float64), series.to_numpy(dtype=np.float64), equal_nan=True):
+                data[column] = downcast
+        elif pd.api.types.is_integer_dtype(series):
+            data[column] = pd.to_numeric(series, downcast='integer')
+        elif series.dtype == 'object':
+            data[column] = series.astype('category')
+    
+    return data
+
+# Concatenate downcast chunks, once every column has the same type in every chunk
+def concat_chunks(chunks):
+    for column in chunks[0].columns:
+        series = [chunk[column] for chunk in chunks]
+        categorical = [isinstance(s.dtype, pd.CategoricalDtype) for s in series]
+
+        if any(categorical):
+            # Chunks with only missing values are read as float, they take the union of the categories of the others
+            if all(is_categorical or s.isna().all() for is_categorical, s in zip(categorical, series)):
+                dtype = pd.CategoricalDtype(union_categoricals([s for is_categorical, s in zip(categorical, series) if is_categorical]).categories)
+            else:
+                dtype = object
+        elif all(pd.api.types.is_numeric_dtype(s) and not pd.api.types.is_bool_dtype(s) for s in series):
+            # Smallest type holding the values of every chunk, e.g. int8 and int16 give int16, float32 and float64 give float64
+            dtype = np.result_type(*[s.dtype for s in series])
+        else:
+            continue
+
+        for chunk in chunks:
+            if chunk[column].dtype != dtype:
+                chunk[column] = chunk[column].astype(dtype)
+    
+    data = pd.concat(chunks, ignore_index=True)
+
+    # High-cardinality strings take less memory as plain objects
+    for column in data.select_dtypes(include='category').columns:
+        if data[column].nunique() > len(data) * CATEGORY_MAX_UNIQUE_RATIO:
+            data[column] = data[column].astype(object)
+    
+    return data
+
+# Read a file with pandas in chunks, downcasting every chunk before the next one is read
+def read_pandas(local_path, file_extension):
+    if file_extension == 'parquet':
+        parquet_file = pq.ParquetFile(local_path)
+        chunks = [downcast_frame(batch.to_pandas()) for batch in parquet_file.iter_batches(batch_size=PANDAS_CHUNK_SIZE)]
+        if not chunks:
+            return parquet_file.schema_arrow.empty_table().to_pandas()
+        return concat_chunks(chunks)
+    
+    elif file_extension == 'csv':
+        chunks = [downcast_frame(chunk) for chunk in pd.read_csv(local_path, chunksize=PANDAS_CHUNK_SIZE)]
+        if not chunks:
+            return pd.read_csv(local_path)
+        return concat_chunks(chunks)
+    
+    elif file_extension == 'xlsx':
+        return downcast_frame(pd.read_excel(local_path))
+    
+    elif file_extension == 'json':
+        return downcast_frame(pd.read_json(local_path))
+    
+    else:
+        raise ValueError("Unsupported file format. Supported formats are .csv, .xlsx, and .json")
+
 # Load dataset file
 def load_file(file_key):
+    '''
+    Load an uploaded file, from its Parquet copy when there is one converted from the current upload
+
+    Parameters
+    - file_key (str): Path of the uploaded file
+
+    Returns
+    - DataFrame: pandas DataFrame for files up to 100 MB, Spark DataFrame above
+    - str: 'pandas' or 'spark'
+    '''
     if not file_key:
         raise ValueError("Error: file_key is None. Check the function call.")
     
     file_name = file_key.split('/')[-1]
     file_path = f"uploaded/{file_name}"
-    s3_path = f"s3://{S3_BUCKET_NAME}/{file_path}"
 
     if not file_name or not file_path:
         raise ValueError("Error: file_path is not generated correctly.")
     
-    # Check if the file exists in S3 bucket
-    try:
-        response = s3.get_object(Bucket=S3_BUCKET_NAME, Key=file_path)
-        file_size = response['ContentLength']
-        print(f"File exists in S3: {file_path}, size: {file_size} bytes")
-    except ClientError as e:
-        if e.response['Error']['Code'] == '404':
-            raise FileNotFoundError(f"File '{file_name}' does not exist in S3 bucket '{S3_BUCKET_NAME}'")
-        else:
-            raise e
+    # Check if the file exists in S3 bucket, a HEAD request does not download the object
+    response = head_file(file_path)
+    if response is None:
+        raise FileNotFoundError(f"File '{file_name}' does not exist in S3 bucket '{S3_BUCKET_NAME}'")
+    file_size = response['ContentLength']
+    print(f"File exists in S3: {file_path}, size: {file_size} bytes")
     
     # Determine file extension
     file_extension = file_name.split('.')[-1]
+    if file_extension not in ('csv', 'xlsx', 'json'):
+        raise ValueError("Unsupported file format. Supported formats are .csv, .xlsx, and .json")
 
     max_file_size = 100 * 1024 * 1024 # 100MB
+    mode = "spark" if file_size > max_file_size else "pandas"
+
+    # Prefer the typed Parquet copy, unless it was converted from an earlier upload with the same name
+    etag = response['ETag'].strip('"')
+    parquet_response = head_file(parquet_key(file_name))
+    if parquet_response is not None and parquet_response.get('Metadata', {}).get(SOURCE_ETAG_METADATA) == etag:
+        if mode == "spark":
+            # Spark executors read S3 directly, a copy on the driver's disk is not visible to them
+            return spark.read.parquet(f"s3://{S3_BUCKET_NAME}/{parquet_key(file_name)}"), mode
+        
+        # Every later read uses the local copy, the object is fetched once per node
+        local_path = fetch_to_cache(parquet_key(file_name), parquet_response['ETag'].strip('"'))
+        return read_pandas(local_path, 'parquet'), mode
+
+    # Files whose conversion has not finished, or failed, are read from the raw file
+    if mode == "spark":
+        s3_path = f"s3://{S3_BUCKET_NAME}/{file_path}"
 
-    if file_size > max_file_size:
-        mode = "spark"
-    
         # Read the file based on its extension with PySpark
         if file_extension == 'csv':
-            return spark.read.csv(s3_path, header=True, inferSchema=True), mode
+            data = spark.read.csv(s3_path, header=True, inferSchema=True)
         elif file_extension == 'json':
-            return spark.read.json(s3_path), mode
+            data = spark.read.json(s3_path)
         else:
             raise ValueError("Unsupported file format. Supported formats are .csv, .xlsx, and .json")
+        
+        return data, mode
     
     else:
-        mode = "pandas"
-
         # Read the file based on its extension with Pandas
-        if file_extension == 'csv':
-            return pd.read_csv(s3_path), mode
-        elif file_extension == 'xlsx':
-            return pd.read_excel(s3_path), mode
-        elif file_extension == 'json':
-            return pd.read_json(s3_path), mode
-        else:
-            raise ValueError("Unsupported file format. Supported formats are .csv, .xlsx, and .json")
+        local_path = fetch_to_cache(file_path, etag)
+        return read_pandas(local_path, file_extension), mode
 
 class spark_processing:
     def spark_preprocessing_data(data, mode):
@@ -85,13 +333,19 @@ class spark_processing:
 
         data = data.na.drop(how='all')
 
-        for col_name in data.columns:
-            try:
-                data = data.withColumn(col_name, col(col_name).cast(DoubleType()))
-            except Exception as e:
-                print(f"Error converting column {col_name}: {e}")
-
-        numeric_cols = [field.name for field in data.schema.fields if isinstance(field.dataType, (DoubleType, FloatType, IntegerType, LongType))]
+        # Numeric columns keep their type, a string column is cast only if every non-null value is a number
+        gender_cols = {'sex', 'gender'}
+        string_cols = [field.name for field in data.schema.fields
+                       if isinstance(field.dataType, StringType) and field.name not in gender_cols]
+        if string_cols:
+            invalid_counts = data.agg(*[
+                F.sum(F.when(col(c).isNotNull() & col(c).cast(DoubleType()).isNull(), 1).otherwise(0)).alias(c)
+                for c in string_cols]).first().asDict()
+            numeric_strings = [c for c in string_cols if not invalid_counts[c]]
+            if numeric_strings:
+                data = data.select(*[col(c).cast(DoubleType()).alias(c) if c in numeric_strings else col(c) for c in data.columns])
+
+        numeric_cols = [field.name for field in data.schema.fields if isinstance(field.dataType, (DoubleType, FloatType, IntegerType, LongType)) and field.name != ROW_ID]
         imputer = Imputer(strategy="mean", inputCols=numeric_cols, outputCols=[f"{c}_imputed" for c in numeric_cols])
 
         try:
@@ -123,22 +377,16 @@ class spark_processing:
 
         return data, gender_mapping
 
-    def spark_standardize_gender(value):
-        if value is None:
-            return "unknown"
-        
-        value = value.lower()
-        if "male" in value or "man" in value or "boy" in value:
-            return "male"
-        elif "female" in value or "woman" in value or "girl" in value:
-            return "female"
-        else:
-            return "unknown"
-
-    standardize_gender_udf = udf(spark_standardize_gender, StringType())
+    def spark_standardize_gender(column_name):
+        # Native column expression, "female", "woman" and "girl" are tested first since they contain "male" and "man"
+        value = lower(col(column_name))
+        return (F.when(value.isNull(), "unknown")
+                 .when(value.contains("female") | value.contains("woman") | value.contains("girl"), "female")
+                 .when(value.contains("male") | value.contains("man") | value.contains("boy"), "male")
+                 .otherwise("unknown"))
 
     def spark_process_gender_column(data, column_name):
-        data = data.withColumn(column_name, spark_processing.standardize_gender_udf(lower(col(column_name))))
+        data = data.withColumn(column_name, spark_processing.spark_standardize_gender(column_name))
 
         indexer = StringIndexer(inputCol=column_name, outputCol=f'{column_name}')
         try:
@@ -150,25 +398,24 @@ class spark_processing:
             return data, {}
         
     def spark_scale_df(data):
-        numeric_cols = [field.name for field in data.schema.fields if isinstance(field.dataType, (DoubleType, FloatType, IntegerType, LongType))]
-
-        for col_name in numeric_cols:
-            # Assemble the column into a vector
-            assembler = VectorAssembler(inputCols=[col_name], outputCol=f"{col_name}_vector")
-            data = assembler.transform(data)
+        numeric_cols = [field.name for field in data.schema.fields if isinstance(field.dataType, (DoubleType, FloatType, IntegerType, LongType)) and field.name != ROW_ID]
+        if not numeric_cols:
+            return data
 
-            # Scale the vectorized column
-            scaler = sparkStandardScaler(inputCol=f"{col_name}_vector", outputCol=f"{col_name}_scaled_vector")
-            scaler_model = scaler.fit(data)
-            data = scaler_model.transform(data)
+        # Standard deviation of every column in one aggregation
+        stddevs = data.agg(*[F.stddev_samp(col_name).alias(col_name) for col_name in numeric_cols]).first().asDict()
 
-            # Extract the scaled value from the vector and replace the original column
-            data = data.withColumn(col_name, F.col(f"{col_name}_scaled_vector")[0])
-            
-            # Drop intermediate vector columns
-            data = data.drop(f"{col_name}_vector", f"{col_name}_scaled_vector")
+        # Scale every column in one select, like StandardScaler (withMean=False): a constant column becomes 0
+        scaled_columns = []
+        for col_name in data.columns:
+            if col_name not in numeric_cols:
+                scaled_columns.append(F.col(col_name))
+            elif not stddevs[col_name]:
+                scaled_columns.append(F.when(F.col(col_name).isNull(), None).otherwise(F.lit(0.0)).alias(col_name))
+            else:
+                scaled_columns.append((F.col(col_name) / F.lit(stddevs[col_name])).alias(col_name))
 
-        return data
+        return data.select(*scaled_columns)
 
 class pandas_processing:
     def pandas_preprocessing_data(data, mode):
@@ -180,7 +427,7 @@ class pandas_processing:
         data = data.dropna(how="all")
 
         for col_name in data.columns:
-            if data[col_name].dtype == 'object':
+            if data[col_name].dtype == 'object' or isinstance(data[col_name].dtype, pd.CategoricalDtype):
                 print(f"Skipping non-numeric column: {col_name}")
             
             else:
@@ -190,10 +437,12 @@ class pandas_processing:
                 except Exception as e:
                     print(f"Error convering column {col_name}: {e}")
         
-        numeric_cols = data.select_dtypes(include=['float64', 'int64']).columns
+        numeric_cols = data.select_dtypes(include='number').columns
         imputer = SimpleImputer(strategy="mean")
         try:
-            data[numeric_cols] = imputer.fit_transform(data[numeric_cols])
+            # Keep the downcast types, integer columns have no missing values to impute
+            imputed = pd.DataFrame(imputer.fit_transform(data[numeric_cols]), columns=numeric_cols, index=data.index)
+            data[numeric_cols] = imputed.astype(data[numeric_cols].dtypes)
 
         except Exception as e:
             print("error during imputation: ", e)
@@ -236,7 +485,7 @@ class pandas_processing:
     
     def pandas_scale_df(data):
         scaler = sklearnStandardScaler()
-        numeric_cols = data.select_dtypes(include=['float64', 'int64']).columns
+        numeric_cols = data.select_dtypes(include='number').columns
 
         data[numeric_cols] = scaler.fit_transform(data[numeric_cols])
         return data
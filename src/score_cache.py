@@ -0,0 +1,182 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import numpy as np
+import pandas as pd
+import boto3
+from botocore.exceptions import ClientError
+from sklearn.pipeline import Pipeline
+from logger_utils import logger
+
+S3_BUCKET_NAME = "ml-platform-service"
+s3 = boto3.client("s3")
+
+# Local SQLite file holding the scores, optionally mirrored to the result bucket
+SCORE_CACHE_PATH = os.environ.get("SCORE_CACHE_PATH", "/tmp/score_cache.sqlite")
+SCORE_CACHE_S3_KEY = "result/score_cache.sqlite"
+SCORE_CACHE_S3 = os.environ.get("SCORE_CACHE_S3", "0") == "1"
+
+# Attributes that control how a model runs, not what it learns
+RUNTIME_ATTRIBUTES = {'n_jobs', 'deadline', 'stopped_early'}
+
+
+def dataset_fingerprint(X, y):
+    '''
+    Compute a content hash of a dataset, independent of its index
+
+    Parameters
+    - X (numpy array or DataFrame): Input features
+    - y (numpy array or Series): Target labels
+
+    Returns
+    - str: Hex digest identifying the dataset content
+    '''
+    X = pd.DataFrame(X)
+    y = pd.Series(np.asarray(y).ravel())
+
+    digest = hashlib.sha256()
+    digest.update(json.dumps([str(c) for c in X.columns]).encode('utf-8'))
+    digest.update(json.dumps([str(t) for t in X.dtypes]).encode('utf-8'))
+    digest.update(pd.util.hash_pandas_object(X, index=False).values.tobytes())
+    digest.update(pd.util.hash_pandas_object(y, index=False).values.tobytes())
+
+    return digest.hexdigest()
+
+
+def describe(value):
+    '''
+    Describe a model, or one of its hyperparameters, as a deterministic JSON-serializable structure
+
+    Parameters
+    - value: Model, Pipeline, hyperparameter value or search distribution
+
+    Returns
+    - Deterministic description of the value
+    '''
+    if isinstance(value, Pipeline):
+        return [[name, describe(step)] for name, step in value.steps]
+
+    if isinstance(value, (str, bool, int, float)) or value is None:
+        return value
+
+    if isinstance(value, (np.integer, np.floating)):
+        return value.item()
+
+    if isinstance(value, (list, tuple)):
+        return [describe(v) for v in value]
+
+    if isinstance(value, dict):
+        return {str(k): describe(v) for k, v in sorted(value.items(), key=lambda item: str(item[0]))}
+
+    # Frozen scipy distributions used in hyperparameter search spaces
+    if hasattr(value, 'dist') and hasattr(value, 'args'):
+        return {'distribution': value.dist.name, 'args': describe(value.args), 'kwds': describe(value.kwds)}
+
+    if hasattr(value, 'get_params'):
+        params = value.get_params(deep=False)
+    else:
+        params = vars(value)
+
+    # Keep only plain hyperparameters, fitted state and runtime settings are not part of the identity
+    params = {k: v for k, v in params.items()
+              if k not in RUNTIME_ATTRIBUTES and (isinstance(v, (str, bool, int, float, np.integer, np.floating)) or v is None)}
+
+    return {'class': f"{type(value).__module__}.{type(value).__qualname__}", 'params': describe(params)}
+
+
+def cache_key(fingerprint, model, **settings):
+    '''
+    Build the cache key of a score
+
+    Parameters
+    - fingerprint (str): Dataset fingerprint (dataset_fingerprint)
+    - model: Model, Pipeline or any description of the model
+    - **settings: Evaluation settings that change the score (mode, folds, seed, search space...)
+
+    Returns
+    - str: Hex digest of the key
+    '''
+    payload = json.dumps([fingerprint, describe(model), describe(settings)], sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class ScoreCache:
+    def __init__(self, path=SCORE_CACHE_PATH, use_s3=SCORE_CACHE_S3, bucket_name=S3_BUCKET_NAME):
+        '''
+        Content-addressed cache of evaluation scores stored in SQLite
+
+        Parameters
+        - path (str): Path of the local SQLite file
+        - use_s3 (bool): If True, the SQLite file is restored from and persisted to the result bucket
+        - bucket_name (str): Name of the S3 bucket
+        '''
+        self.path = path
+        self.use_s3 = use_s3
+        self.bucket_name = bucket_name
+
+    def _connect(self):
+        # One short-lived connection per call, so the cache can be shared by worker processes
+        connection = sqlite3.connect(self.path, timeout=30)
+        connection.execute("CREATE TABLE IF NOT EXISTS scores (key TEXT PRIMARY KEY, score REAL, model TEXT, created REAL)")
+        return connection
+
+    def get(self, key):
+        '''
+        Return the cached score for a key, None if missing
+        '''
+        try:
+            with self._connect() as connection:
+                row = connection.execute("SELECT score FROM scores WHERE key = ?", (key,)).fetchone()
+            return None if row is None else row[0]
+        except sqlite3.Error as e:
+            logger.error(f"Error reading the score cache: {e}")
+            return None
+
+    def put(self, key, score, model_name=None):
+        '''
+        Store a score for a key
+        '''
+        if score is None or not np.isfinite(score):
+            return
+
+        try:
+            with self._connect() as connection:
+                connection.execute("INSERT OR REPLACE INTO scores VALUES (?, ?, ?, ?)",
+                                   (key, float(score), model_name, time.time()))
+        except sqlite3.Error as e:
+            logger.error(f"Error writing the score cache: {e}")
+
+    def restore_from_s3(self):
+        '''
+        Download the cache from the result bucket if it is enabled and there is no local copy yet
+        '''
+        if not self.use_s3 or os.path.exists(self.path):
+            return
+
+        try:
+            s3.download_file(self.bucket_name, SCORE_CACHE_S3_KEY, self.path)
+            logger.info(f"Score cache restored from S3: {SCORE_CACHE_S3_KEY}")
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                logger.info("No score cache in S3 yet.")
+            else:
+                logger.error(f"Error restoring the score cache from S3: {e}")
+
+    def persist_to_s3(self):
+        '''
+        Upload the cache to the result bucket if it is enabled
+        The last upload wins, so concurrent jobs may lose each other's new entries, which only costs recomputation
+        '''
+        if not self.use_s3 or not os.path.exists(self.path):
+            return
+
+        try:
+            s3.upload_file(self.path, self.bucket_name, SCORE_CACHE_S3_KEY)
+            logger.info(f"Score cache persisted to S3: {SCORE_CACHE_S3_KEY}")
+        except ClientError as e:
+            logger.error(f"Error persisting the score cache to S3: {e}")
+
+
+score_cache = ScoreCache()
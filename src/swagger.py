@@ -42,6 +42,18 @@ swagger = {
                         "in": "formData",
                         "type": "string",
                         "description": "Whether to generate a plot."
+                    },
+                    {
+                        "name": "representatives",
+                        "in": "formData",
+                        "type": "string",
+                        "description": "Agglomerative representatives above 10000 rows: 'sample' (default) or 'micro'."
+                    },
+                    {
+                        "name": "connectivity_neighbors",
+                        "in": "formData",
+                        "type": "integer",
+                        "description": "Restrict Agglomerative merges to a k-nearest-neighbor graph with this many neighbors."
                     }
                 ],
                 "responses": {